@@ -1,35 +1,85 @@
 import discord
 import os
-import json
 import datetime
+import re
 from discord.ext import commands
-from config import ALLOWED_CATEGORY_ID, ALLOWED_ROLE_ID, SUPER_ADMIN_ROLE_ID, MEMBER_ROLE_ID, USER_IDS_FILE, CONFIG_FILE, INFOS_FILE
+from purgeEngine import PurgeFilter
+from outboundScheduler import MODERATION
+
+PURGE_FILTER_KEYS = ('user', 'persona', 'regex', 'has', 'before', 'after')
 
 class AdminCmd(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        self.guild_states = bot.guild_states
+        self.permissions = bot.permissions
+        self._overwrites = {}
+        self.guild_states.subscribe(self._on_config_change)
+
+    def _on_config_change(self, config):
+        # Channel overwrites are built from the role lists, so rebuild that guild's after the next config change
+        self._drop_overwrites(config.guild_id)
+
+    @commands.Cog.listener()
+    async def on_guild_role_delete(self, role):
+        self._drop_overwrites(role.guild.id)
+
+    def _drop_overwrites(self, guild_id):
+        for key in [key for key in self._overwrites if key[0] == guild_id]:
+            del self._overwrites[key]
+
+    def _channel_overwrites(self, guild, admin_only):
+        key = (guild.id, admin_only)
+        overwrites = self._overwrites.get(key)
+        if overwrites is None:
+            config = self.guild_states.config(guild)
+            if admin_only:
+                # Restrict to admins and super admins only
+                overwrites = {
+                    guild.default_role: discord.PermissionOverwrite(view_channel=False),
+                    guild.get_role(config.admin_roles[0]): discord.PermissionOverwrite(view_channel=True, send_messages=True, read_message_history=True),
+                    guild.get_role(config.super_admin_role): discord.PermissionOverwrite(view_channel=True, send_messages=True, read_message_history=True)
+                }
+            else:
+                overwrites = {
+                    guild.default_role: discord.PermissionOverwrite(view_channel=False)
+                }
+                # Add member and admin roles to overwrites by default
+                for role_id in config.member_roles + config.admin_roles:
+                    role = guild.get_role(role_id)
+                    if role:
+                        overwrites[role] = discord.PermissionOverwrite(view_channel=True, send_messages=True, read_message_history=True)
+            self._overwrites[key] = overwrites
+        return dict(overwrites)
 
     @commands.command(name='purgeChannel')
     async def purge_channel(self, ctx, *, args: str = None):
         # Check if user has allowed role
-        if not any(role.id in ALLOWED_ROLE_ID for role in ctx.author.roles):
+        if not self.permissions.is_admin(ctx.author):
             await ctx.send("You are not allowed to use this command.")
             return
 
-        if not args:
-            # No arguments: purge all messages in current channel
-            channel = ctx.channel
-            try:
-                messages = [msg async for msg in channel.history(limit=None)]
-                if not messages:
-                    await ctx.send("No messages to purge in this channel.")
+        # Pull key:value filters out before parsing amount and channel
+        purge_filter = None
+        if args:
+            positional = []
+            filter_tokens = []
+            for token in args.split():
+                if ':' in token and token.split(':', 1)[0].lower() in PURGE_FILTER_KEYS:
+                    filter_tokens.append(token)
+                else:
+                    positional.append(token)
+            if filter_tokens:
+                try:
+                    purge_filter = await self._parse_purge_filter(ctx, filter_tokens)
+                except ValueError as e:
+                    await ctx.send(str(e))
                     return
-                deleted = await channel.purge(limit=len(messages))
-                await ctx.send(f"Purged {len(deleted)} messages from {channel.mention}.", delete_after=5)
-            except discord.Forbidden:
-                await ctx.send("I lack permissions to purge messages in this channel.")
-            except Exception as e:
-                await ctx.send("An error occurred while purging messages.")
+            args = ' '.join(positional)
+
+        if not args:
+            # No amount or channel: purge all (matching) messages in current channel
+            await self._run_purge(ctx, ctx.channel, None, purge_filter)
             return
 
         # Parse arguments
@@ -76,56 +126,90 @@ class AdminCmd(commands.Cog):
                 await ctx.send("Amount must be greater than 0.")
                 return
 
-        # If amount is None, set to total messages
-        if amount is None:
-            try:
-                messages = [msg async for msg in channel.history(limit=None)]
-                amount = len(messages)
-            except discord.Forbidden:
-                await ctx.send("I lack permissions to read message history in this channel.")
-                return
-        else:
-            # Cap amount to actual messages
-            try:
-                messages = [msg async for msg in channel.history(limit=amount)]
-                actual_amount = len(messages)
-                if actual_amount < amount:
-                    amount = actual_amount
-            except discord.Forbidden:
-                await ctx.send("I lack permissions to read message history in this channel.")
-                return
-
-        if amount == 0:
-            await ctx.send("No messages to purge.")
+        await self._run_purge(ctx, channel, amount, purge_filter)
+
+    async def _parse_purge_filter(self, ctx, tokens):
+        purge_filter = PurgeFilter()
+        for token in tokens:
+            key, value = token.split(':', 1)
+            key = key.lower()
+            if not value:
+                raise ValueError(f"Missing value for the {key} filter.")
+            if key == 'user':
+                user_id = value.strip('<@!>')
+                if user_id.isdigit():
+                    purge_filter.author_id = int(user_id)
+                else:
+                    member = await self.bot.member_lookup.get_named(ctx.guild, value)
+                    if not member:
+                        raise ValueError(f"User {value} not found.")
+                    purge_filter.author_id = member.id
+            elif key == 'persona':
+                if not value.startswith(('user_', 'admin_')):
+                    raise ValueError("Persona must look like user_xxx or admin_xxx.")
+                purge_filter.persona = value
+            elif key == 'regex':
+                try:
+                    purge_filter.pattern = re.compile(value)
+                except re.error as e:
+                    raise ValueError(f"Invalid regex: {e}")
+            elif key == 'has':
+                if value.lower() != 'attachments':
+                    raise ValueError("Only has:attachments is supported.")
+                purge_filter.has_attachments = True
+            else:
+                try:
+                    timestamp = datetime.datetime.fromisoformat(value)
+                except ValueError:
+                    raise ValueError(f"Invalid {key} timestamp. Use YYYY-MM-DD or YYYY-MM-DDTHH:MM (UTC).")
+                if timestamp.tzinfo is None:
+                    timestamp = timestamp.replace(tzinfo=datetime.timezone.utc)
+                setattr(purge_filter, key, timestamp)
+        return purge_filter
+
+    async def _run_purge(self, ctx, channel, amount, predicate=None):
+        engine = self.bot.purge_engine
+        if engine.running(channel.id):
+            await ctx.send(f"A purge is already running in {channel.mention}. Use MM cancelPurge to stop it.")
             return
 
-        # Perform purge
+        # The progress message is edited as the purge streams through the history
+        progress = await ctx.send(f"Purging {channel.mention}...")
         try:
-            deleted = await channel.purge(limit=amount)
-            await ctx.send(f"Purged {len(deleted)} messages from {channel.mention}.", delete_after=5)
+            job = await engine.run(channel, limit=amount, predicate=predicate, exclude={progress.id}, progress=progress)
         except discord.Forbidden:
-            await ctx.send("I lack permissions to purge messages in this channel.")
-        except discord.NotFound:
-            await ctx.send("Some messages could not be found (may have been deleted already).")
+            await progress.edit(content="I lack permissions to purge messages in this channel.")
+            return
         except Exception as e:
-            await ctx.send("An error occurred while purging messages.")
+            await progress.edit(content="An error occurred while purging messages.")
+            return
+
+        if job.matched == 0:
+            await progress.edit(content="No messages to purge.")
+            return
+        summary = f"{'Cancelled purge after deleting' if job.cancelled else 'Purged'} {job.deleted} messages from {channel.mention}."
+        if job.failed:
+            summary += f" {job.failed} could not be deleted."
+        await progress.edit(content=summary, delete_after=5)
+
+    @commands.command(name='cancelPurge')
+    async def cancel_purge(self, ctx, channel: discord.TextChannel = None):
+        # Check if user has allowed role
+        if not self.permissions.is_admin(ctx.author):
+            await ctx.send("You are not allowed to use this command.")
+            return
+
+        channel = channel or ctx.channel
+        if self.bot.purge_engine.cancel(channel.id):
+            await ctx.send(f"Cancelling the purge in {channel.mention}.")
+        else:
+            await ctx.send(f"No purge is running in {channel.mention}.")
 
     @commands.command(name='makeChannel')
     async def make_channel(self, ctx, category_name: str, channel_name: str, *, args: str = None):
-        # Reload infos to ensure up to date
-        try:
-            with open(INFOS_FILE, 'r') as f:
-                infos = json.load(f)
-            global ALLOWED_CATEGORY_ID, ALLOWED_ROLE_ID, SUPER_ADMIN_ROLE_ID, MEMBER_ROLE_ID
-            ALLOWED_CATEGORY_ID = infos.get("allowed_category")
-            ALLOWED_ROLE_ID = infos.get("admin_roles", [])
-            SUPER_ADMIN_ROLE_ID = infos.get("super_admin_role")
-            MEMBER_ROLE_ID = infos.get("member_roles", [])
-        except Exception as e:
-            print(f"Error reloading infos in makeChannel: {e}")
 
         # Check if member roles are set
-        if not MEMBER_ROLE_ID:
+        if not self.guild_states.config(ctx.guild).member_roles:
             await ctx.send("Member roles must be set before using this command.")
             return
 
@@ -140,8 +224,8 @@ class AdminCmd(commands.Cog):
             as_admin = 'asadmin' in parts
 
         # Check permissions: members and higher if not asAdmin, admin required for asAdmin
-        has_member = any(role.id in MEMBER_ROLE_ID for role in ctx.author.roles)
-        has_admin = any(role.id in ALLOWED_ROLE_ID for role in ctx.author.roles)
+        has_member = self.permissions.is_member(ctx.author)
+        has_admin = self.permissions.is_admin(ctx.author)
         if as_admin:
             if not has_admin:
                 await ctx.send("You are not allowed to use the asAdmin flag.")
@@ -152,7 +236,7 @@ class AdminCmd(commands.Cog):
                 return
 
         # Check permissions for flags
-        if admin_only and not any(role.id == SUPER_ADMIN_ROLE_ID for role in ctx.author.roles):
+        if admin_only and not self.permissions.is_super_admin(ctx.author):
             await ctx.send("Only super admins can use the adminOnly flag.")
             return
 
@@ -162,34 +246,8 @@ class AdminCmd(commands.Cog):
             await ctx.send("Category not found.")
             return
 
-        # Set permissions
-        overwrites = {
-            ctx.guild.default_role: discord.PermissionOverwrite(view_channel=False)
-        }
-
-        # Add member roles to overwrites by default
-        for role_id in MEMBER_ROLE_ID:
-            role = ctx.guild.get_role(role_id)
-            if role:
-                overwrites[role] = discord.PermissionOverwrite(view_channel=True, send_messages=True, read_message_history=True)
-
-        # Add admin roles to overwrites
-        for role_id in ALLOWED_ROLE_ID:
-            role = ctx.guild.get_role(role_id)
-            if role:
-                overwrites[role] = discord.PermissionOverwrite(view_channel=True, send_messages=True, read_message_history=True)
-
-        if as_admin:
-            # as_admin flag doesn't change permissions in this implementation, but kept for compatibility
-            pass
-
-        if admin_only:
-            # Restrict to admins and super admins only
-            overwrites = {
-                ctx.guild.default_role: discord.PermissionOverwrite(view_channel=False),
-                ctx.guild.get_role(ALLOWED_ROLE_ID[0]): discord.PermissionOverwrite(view_channel=True, send_messages=True, read_message_history=True),
-                ctx.guild.get_role(SUPER_ADMIN_ROLE_ID): discord.PermissionOverwrite(view_channel=True, send_messages=True, read_message_history=True)
-            }
+        # Set permissions (built once per config change)
+        overwrites = self._channel_overwrites(ctx.guild, admin_only)
 
         try:
             if voc:
@@ -204,7 +262,7 @@ class AdminCmd(commands.Cog):
     @commands.command(name='removeChannel')
     async def remove_channel(self, ctx, category_name: str, channel_name: str):
         # Check if user has admin role
-        if not any(role.id in ALLOWED_ROLE_ID for role in ctx.author.roles):
+        if not self.permissions.is_admin(ctx.author):
             await ctx.send("You are not allowed to use this command.")
             return
 
@@ -229,17 +287,17 @@ class AdminCmd(commands.Cog):
     @commands.command(name='makeUser')
     async def make_user(self, ctx, user: discord.Member):
         # Check if executor has admin role
-        if not any(role.id in ALLOWED_ROLE_ID for role in ctx.author.roles):
+        if not self.permissions.is_admin(ctx.author):
             await ctx.send("You are not allowed to use this command.")
             return
 
         # Check if target has super admin role
-        if any(role.id == SUPER_ADMIN_ROLE_ID for role in user.roles):
+        if self.permissions.is_super_admin(user):
             await ctx.send("You cannot grant member role to a super admin.")
             return
 
         # Add member role to user
-        member_role = discord.utils.get(ctx.guild.roles, id=MEMBER_ROLE_ID)
+        member_role = discord.utils.get(ctx.guild.roles, id=self.guild_states.config(ctx.guild).member_roles)
         if member_role:
             try:
                 await user.add_roles(member_role)
@@ -251,118 +309,85 @@ class AdminCmd(commands.Cog):
                 return
 
         # Update user data
-        try:
-            with open(USER_IDS_FILE, 'r') as f:
-                user_ids = json.load(f)
-        except FileNotFoundError:
-            await ctx.send("No user data found.")
-            return
-
+        user_store = self.guild_states.user_store(ctx.guild)
         user_key = str(user)
-        if user_key not in user_ids:
+        if not user_store.get(user_key):
             await ctx.send("User not found in database.")
             return
 
-        data = user_ids[user_key]
-        if isinstance(data, str):
-            await ctx.send("User data is in old format. Please have them use MM generateID to migrate.")
-            return
-
-        # Update role to member if not already
-        if data["role"] != "member":
-            data["role"] = "member"
-        role_history = data.get("role_history", [])
-        role_history.append({"role": "member", "timestamp": datetime.datetime.now().isoformat()})
-        data["role_history"] = role_history
-
-        # Write back to file
-        with open(USER_IDS_FILE, 'w') as f:
-            json.dump(user_ids, f, indent=4)
+        # Update role to member and record it in the history
+        user_store.set_role(user_key, "member")
 
         await ctx.send(f"Granted member role to {user.mention}.")
 
     @commands.command(name='warnUser')
     async def warn_user(self, ctx, user: discord.Member):
         # Check if executor has admin role
-        if not any(role.id in ALLOWED_ROLE_ID for role in ctx.author.roles):
+        if not self.permissions.is_admin(ctx.author):
             await ctx.send("You are not allowed to use this command.")
             return
 
         # Check if target has super admin role
-        if any(role.id == SUPER_ADMIN_ROLE_ID for role in user.roles):
+        if self.permissions.is_super_admin(user):
             await ctx.send("You cannot warn a super admin.")
             return
 
         # Get admin_id of executor
         try:
-            with open(USER_IDS_FILE, 'r') as f:
-                user_ids = json.load(f)
-            user_key = str(ctx.author)
-            user_data = user_ids.get(user_key)
+            user_store = self.guild_states.user_store(ctx.guild)
+            user_data = user_store.get(str(ctx.author))
             if not user_data or not user_data.get("admin_id"):
                 await ctx.send("You don't have an admin ID.")
                 return
             admin_id = user_data["admin_id"]
             # Get warned user's data
-            user_key_warned = str(user)
-            user_data_warned = user_ids.get(user_key_warned)
+            user_data_warned = user_store.get(str(user))
             if not user_data_warned:
                 await ctx.send("Warned user not found in database.")
                 return
-            user_channel_name = user_data_warned["user_id"]
         except Exception as e:
             await ctx.send("Error loading user IDs.")
             return
 
         warning_msg = f"You have been warned by admin_{admin_id}."
 
-        # Send in user's private channel
-        category = ctx.guild.get_channel(ALLOWED_CATEGORY_ID)
-        if category:
-            channel = discord.utils.get(category.channels, name=user_channel_name)
+        # Send in user's private channel, creating it if channels are lazy and it doesn't exist yet
+        try:
+            channel = await self.bot.private_channels.ensure(user, lane=MODERATION)
             if channel:
-                try:
-                    await channel.send(warning_msg)
-                except Exception as e:
-                    pass
+                await self.bot.outbound.run(MODERATION, channel.send(warning_msg), guild=ctx.guild)
+        except Exception as e:
+            pass
 
         # Send DM
-        try:
-            await user.send(warning_msg)
-        except discord.HTTPException:
-            pass
+        await self.bot.direct_messages.send(user, warning_msg, lane=MODERATION)
 
         await ctx.send(f"Warned {user.mention}.")
 
     @commands.command(name='kickUser')
     async def kick_user(self, ctx, user: discord.Member):
         # Check if executor has admin role
-        if not any(role.id in ALLOWED_ROLE_ID for role in ctx.author.roles):
+        if not self.permissions.is_admin(ctx.author):
             await ctx.send("You are not allowed to use this command.")
             return
 
         # Check if target has super admin role
-        if any(role.id == SUPER_ADMIN_ROLE_ID for role in user.roles):
+        if self.permissions.is_super_admin(user):
             await ctx.send("You cannot kick a super admin.")
             return
 
         # Delete private channel before kicking
         try:
-            with open(USER_IDS_FILE, 'r') as f:
-                user_ids = json.load(f)
-            user_key = str(user)
-            user_data = user_ids.get(user_key)
-            if user_data and isinstance(user_data, dict):
+            user_data = self.guild_states.user_store(ctx.guild).get(str(user))
+            if user_data:
                 user_id = user_data["user_id"]
-                category = ctx.guild.get_channel(ALLOWED_CATEGORY_ID)
-                if category:
-                    channel = discord.utils.get(category.channels, name=user_id)
-                    if channel:
-                        try:
-                            await channel.delete()
-                            print(f"Deleted private channel {user_id} for {user}")
-                        except Exception as e:
-                            print(f"Error deleting channel for {user}: {e}")
+                channel = await self.bot.private_channels.fetch(ctx.guild, str(user))
+                if channel:
+                    try:
+                        await self.bot.outbound.run(MODERATION, channel.delete(), guild=ctx.guild)
+                        print(f"Deleted private channel {user_id} for {user}")
+                    except Exception as e:
+                        print(f"Error deleting channel for {user}: {e}")
         except Exception as e:
             print(f"Error loading user data for {user}: {e}")
 
@@ -377,32 +402,27 @@ class AdminCmd(commands.Cog):
     @commands.command(name='banUser')
     async def ban_user(self, ctx, user: discord.Member):
         # Check if executor has admin role
-        if not any(role.id in ALLOWED_ROLE_ID for role in ctx.author.roles):
+        if not self.permissions.is_admin(ctx.author):
             await ctx.send("You are not allowed to use this command.")
             return
 
         # Check if target has super admin role
-        if any(role.id == SUPER_ADMIN_ROLE_ID for role in user.roles):
+        if self.permissions.is_super_admin(user):
             await ctx.send("You cannot ban a super admin.")
             return
 
         # Delete private channel before banning
         try:
-            with open(USER_IDS_FILE, 'r') as f:
-                user_ids = json.load(f)
-            user_key = str(user)
-            user_data = user_ids.get(user_key)
-            if user_data and isinstance(user_data, dict):
+            user_data = self.guild_states.user_store(ctx.guild).get(str(user))
+            if user_data:
                 user_id = user_data["user_id"]
-                category = ctx.guild.get_channel(ALLOWED_CATEGORY_ID)
-                if category:
-                    channel = discord.utils.get(category.channels, name=user_id)
-                    if channel:
-                        try:
-                            await channel.delete()
-                            print(f"Deleted private channel {user_id} for {user}")
-                        except Exception as e:
-                            print(f"Error deleting channel for {user}: {e}")
+                channel = await self.bot.private_channels.fetch(ctx.guild, str(user))
+                if channel:
+                    try:
+                        await self.bot.outbound.run(MODERATION, channel.delete(), guild=ctx.guild)
+                        print(f"Deleted private channel {user_id} for {user}")
+                    except Exception as e:
+                        print(f"Error deleting channel for {user}: {e}")
         except Exception as e:
             print(f"Error loading user data for {user}: {e}")
 
@@ -417,17 +437,17 @@ class AdminCmd(commands.Cog):
     @commands.command(name='removeMemberRole')
     async def remove_member_role(self, ctx, user: discord.Member):
         # Check if executor has admin role
-        if not any(role.id in ALLOWED_ROLE_ID for role in ctx.author.roles):
+        if not self.permissions.is_admin(ctx.author):
             await ctx.send("You are not allowed to use this command.")
             return
 
         # Check if target has super admin role
-        if any(role.id == SUPER_ADMIN_ROLE_ID for role in user.roles):
+        if self.permissions.is_super_admin(user):
             await ctx.send("You cannot remove member role from a super admin.")
             return
 
         # Remove member role from user
-        member_role = discord.utils.get(ctx.guild.roles, id=MEMBER_ROLE_ID)
+        member_role = discord.utils.get(ctx.guild.roles, id=self.guild_states.config(ctx.guild).member_roles)
         if member_role:
             try:
                 await user.remove_roles(member_role)
@@ -439,56 +459,32 @@ class AdminCmd(commands.Cog):
                 return
 
         # Update user data
-        try:
-            with open(USER_IDS_FILE, 'r') as f:
-                user_ids = json.load(f)
-        except FileNotFoundError:
-            await ctx.send("No user data found.")
-            return
-
+        user_store = self.guild_states.user_store(ctx.guild)
         user_key = str(user)
-        if user_key not in user_ids:
+        data = user_store.get(user_key)
+        if not data:
             await ctx.send("User not found in database.")
             return
 
-        data = user_ids[user_key]
-        if isinstance(data, str):
-            await ctx.send("User data is in old format. Please have them use MM generateID to migrate.")
-            return
-
         # Update role to user if was member
         if data["role"] == "member":
-            data["role"] = "user"
-            role_history = data.get("role_history", [])
-            role_history.append("user")
-            data["role_history"] = role_history
-
-            # Write back to file
-            with open(USER_IDS_FILE, 'w') as f:
-                json.dump(user_ids, f, indent=4)
+            user_store.set_role(user_key, "user")
 
         await ctx.send(f"Removed member role from {user.mention}.")
 
     @commands.command(name='displayMemberRoleHistory')
     async def display_member_role_history(self, ctx):
         # Check if executor has admin role
-        if not any(role.id in ALLOWED_ROLE_ID for role in ctx.author.roles):
+        if not self.permissions.is_admin(ctx.author):
             await ctx.send("You are not allowed to use this command.")
             return
 
-        try:
-            with open(USER_IDS_FILE, 'r') as f:
-                user_ids = json.load(f)
-        except FileNotFoundError:
-            await ctx.send("No user data found.")
-            return
-
         embed = discord.Embed(title="Member Role History", color=0x00ff00)
 
         now = datetime.datetime.now()
 
-        for user_key, data in user_ids.items():
-            if isinstance(data, dict) and data.get("role_history"):
+        for user_key, data in self.guild_states.user_store(ctx.guild).items():
+            if data.get("role_history"):
                 role_history = data["role_history"]
                 member_timestamps = []
                 for entry in role_history:
@@ -0,0 +1,77 @@
+import asyncio
+import io
+import tempfile
+import discord
+
+# Downloads running at once across all messages
+MAX_CONCURRENT_DOWNLOADS = 4
+# Total attachment bytes relayed for one message (Discord's own upload limit)
+MAX_MESSAGE_BYTES = 25 * 1024 * 1024
+# Attachments larger than this are spilled to a temporary file instead of kept in memory
+SPOOL_THRESHOLD = 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+
+
+class AttachmentError(Exception):
+    pass
+
+
+class AttachmentRelay:
+    def __init__(self, bot, max_concurrent=MAX_CONCURRENT_DOWNLOADS, max_message_bytes=MAX_MESSAGE_BYTES, spool_threshold=SPOOL_THRESHOLD):
+        self.bot = bot
+        self.max_message_bytes = max_message_bytes
+        self.spool_threshold = spool_threshold
+        self.semaphore = asyncio.Semaphore(max_concurrent)
+
+    async def fetch_all(self, attachments):
+        # Returns (files, failures) where failures is a list of (filename, reason)
+        failures = []
+        accepted = []
+        budget = self.max_message_bytes
+        for attachment in attachments:
+            if attachment.size > budget:
+                failures.append((attachment.filename, f"over the {self.max_message_bytes // (1024 * 1024)} MB per-message limit"))
+                continue
+            budget -= attachment.size
+            accepted.append(attachment)
+
+        results = await asyncio.gather(*(self._fetch(attachment) for attachment in accepted), return_exceptions=True)
+        files = []
+        for attachment, result in zip(accepted, results):
+            if isinstance(result, discord.File):
+                files.append(result)
+            elif isinstance(result, AttachmentError):
+                failures.append((attachment.filename, str(result)))
+            else:
+                failures.append((attachment.filename, f"download failed ({result.__class__.__name__})"))
+        return files, failures
+
+    async def _fetch(self, attachment):
+        async with self.semaphore:
+            async with self.bot.http_session.get(attachment.url) as resp:
+                if resp.status != 200:
+                    raise AttachmentError(f"HTTP {resp.status}")
+                buffer = io.BytesIO()
+                received = 0
+                try:
+                    async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+                        received += len(chunk)
+                        if received > attachment.size:
+                            raise AttachmentError("larger than announced")
+                        if isinstance(buffer, io.BytesIO) and received > self.spool_threshold:
+                            # Spill to disk so a burst of large uploads doesn't balloon memory
+                            spooled = tempfile.TemporaryFile()
+                            spooled.write(buffer.getbuffer())
+                            buffer = spooled
+                        buffer.write(chunk)
+                except BaseException:
+                    buffer.close()
+                    raise
+                buffer.seek(0)
+                return discord.File(buffer, filename=attachment.filename)
+
+    def close_files(self, files):
+        # discord.File leaves buffers it didn't open itself, so release them here
+        for file in files:
+            file.close()
+            file.fp.close()
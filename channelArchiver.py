@@ -0,0 +1,189 @@
+import asyncio
+import datetime
+import json
+import os
+import shutil
+import discord
+from outboundScheduler import BACKGROUND
+
+# How often idle private channels are looked for
+SWEEP_INTERVAL = 60 * 60
+# Archives larger than this are kept on disk instead of being uploaded on restore; also
+# Discord's limit for one message's files, so larger attachments are not archived
+MAX_RESTORE_BYTES = 25 * 1024 * 1024
+# Files Discord accepts on one message
+MAX_RESTORE_FILES = 10
+# Attachments kept per archived channel; beyond this they are recorded as lost.
+# Their URLs expire, so an attachment that isn't downloaded can't be restored.
+MAX_ARCHIVED_ATTACHMENT_BYTES = 100 * 1024 * 1024
+
+
+class ChannelArchiver:
+    def __init__(self, bot):
+        self.bot = bot
+        self.guild_states = bot.guild_states
+        self.metrics = bot.metrics
+        self._task = None
+
+    def _path(self, guild, user_id):
+        return os.path.join(self.guild_states.get(guild).archive_dir, f"{user_id}.jsonl")
+
+    def _files_dir(self, guild, user_id):
+        return os.path.join(self.guild_states.get(guild).archive_dir, str(user_id))
+
+    def has_archive(self, guild, user_id):
+        return os.path.exists(self._path(guild, user_id))
+
+    def last_activity(self, channel):
+        if channel.last_message_id:
+            return discord.utils.snowflake_time(channel.last_message_id)
+        return channel.created_at
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                archived = await self.sweep()
+                if archived:
+                    print(f"Archived {archived} inactive private channels")
+            except Exception as e:
+                print(f"Error sweeping inactive private channels: {e}")
+            await asyncio.sleep(SWEEP_INTERVAL)
+
+    async def sweep(self):
+        # Least recently used channels go first: every channel idle past archive_idle_days,
+        # plus the oldest ones beyond max_live_channels
+        now = discord.utils.utcnow()
+        archived = 0
+        for guild, state in self.guild_states.loaded():
+            idle_days = state.config.archive_idle_days
+            max_live = state.config.max_live_channels
+            if not idle_days and not max_live:
+                continue
+            live = []
+            for channel_id, user_key in list(state.user_store.by_channel_id.items()):
+                channel = guild.get_channel(channel_id)
+                # Threads archive themselves; only channels take up slots
+                if isinstance(channel, discord.TextChannel):
+                    live.append((self.last_activity(channel), channel, user_key))
+            live.sort(key=lambda entry: entry[0])
+            excess = len(live) - max_live if max_live else 0
+            for index, (last_active, channel, user_key) in enumerate(live):
+                if index >= excess and not (idle_days and now - last_active > datetime.timedelta(days=idle_days)):
+                    break
+                try:
+                    if await self.archive(channel, user_key):
+                        archived += 1
+                except discord.HTTPException as e:
+                    print(f"Could not archive {channel}: {e}")
+        return archived
+
+    async def archive(self, channel, user_key):
+        # Export the history, then delete the channel; it comes back on the user's next use
+        user_store = self.guild_states.user_store(channel.guild)
+        record = user_store.get(user_key)
+        if record is None:
+            # The user left while the sweep was running; leaving removed their channel
+            return False
+        path = self._path(channel.guild, record["user_id"])
+        files_dir = self._files_dir(channel.guild, record["user_id"])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        exported = lost = 0
+        stored = sum(entry.stat().st_size for entry in os.scandir(files_dir)) if os.path.isdir(files_dir) else 0
+        # Append, so an archive that was never restored is not overwritten
+        with open(path, 'a', encoding='utf-8') as f:
+            async for message in channel.history(limit=None, oldest_first=True):
+                attachments = []
+                for index, attachment in enumerate(message.attachments):
+                    # "file" is the copy under files_dir, or None if the attachment was lost
+                    name = None
+                    if attachment.size <= MAX_RESTORE_BYTES and stored + attachment.size <= MAX_ARCHIVED_ATTACHMENT_BYTES:
+                        name = f"{message.id}-{index}-{os.path.basename(attachment.filename)}"
+                        try:
+                            os.makedirs(files_dir, exist_ok=True)
+                            await attachment.save(os.path.join(files_dir, name))
+                            stored += attachment.size
+                        except discord.HTTPException as e:
+                            print(f"Could not archive attachment {attachment.filename} from {channel}: {e}")
+                            name = None
+                    if name is None:
+                        lost += 1
+                    attachments.append({"filename": attachment.filename, "file": name})
+                f.write(json.dumps({
+                    "id": message.id,
+                    "author": message.author.name,
+                    "created_at": message.created_at.isoformat(),
+                    "content": message.content,
+                    "attachments": attachments
+                }) + "\n")
+                exported += 1
+        if user_store.get(user_key) is None:
+            # Left during the export: their messages must not outlive them on disk
+            self.discard(channel.guild, record["user_id"])
+            return False
+        await self.bot.outbound.run(BACKGROUND, channel.delete(reason="Archived after inactivity"), guild=channel.guild)
+        user_store.update(user_key, channel_id=None)
+        self.metrics.incr("channel_archive.archived")
+        if lost:
+            self.metrics.incr("channel_archive.attachments_lost", lost)
+        print(f"Archived {exported} messages from {channel} ({user_key}), {lost} attachments lost")
+
+        member = await self.bot.member_lookup.get_named(channel.guild, user_key)
+        if member:
+            notice = "Your private channel was archived after a period of inactivity. Use 'MM openChannel' to get it back with its history."
+            if lost:
+                notice += f" {lost} attachment(s) were too large to keep or could not be downloaded, and won't come back."
+            await self.bot.direct_messages.send(member, notice)
+        return True
+
+    def discard(self, guild, user_id):
+        # Called when the user leaves, like deleting their live channel
+        files_dir = self._files_dir(guild, user_id)
+        found = os.path.isdir(files_dir)
+        shutil.rmtree(files_dir, ignore_errors=True)
+        try:
+            os.remove(self._path(guild, user_id))
+            found = True
+        except FileNotFoundError:
+            pass
+        if found:
+            self.metrics.incr("channel_archive.discarded")
+        return found
+
+    def _file_batches(self, files_dir):
+        # Archived attachments in message order, grouped to fit on one message each
+        names = sorted(os.listdir(files_dir), key=lambda name: [int(part) for part in name.split('-', 2)[:2]])
+        batch, size = [], 0
+        for name in names:
+            file_size = os.path.getsize(os.path.join(files_dir, name))
+            if batch and (len(batch) >= MAX_RESTORE_FILES or size + file_size > MAX_RESTORE_BYTES):
+                yield batch
+                batch, size = [], 0
+            batch.append(name)
+            size += file_size
+        if batch:
+            yield batch
+
+    async def restore(self, channel, user_id, lane=BACKGROUND):
+        # Post the archived history into a recreated channel, then drop the archive
+        path = self._path(channel.guild, user_id)
+        if not os.path.exists(path):
+            return False
+        if os.path.getsize(path) > MAX_RESTORE_BYTES:
+            await self.bot.outbound.run(lane, channel.send("Your previous channel's history is too large to upload here; ask an admin for the export."), guild=channel.guild)
+            return False
+        with open(path, 'rb') as f:
+            await self.bot.outbound.run(lane, channel.send("History from your archived channel:", file=discord.File(f, filename=f"{user_id}-history.jsonl")), guild=channel.guild)
+        files_dir = self._files_dir(channel.guild, user_id)
+        if os.path.isdir(files_dir):
+            for batch in self._file_batches(files_dir):
+                # Uploaded under the original filename, without the message ID and index prefix
+                files = [discord.File(os.path.join(files_dir, name), filename=name.split('-', 2)[2]) for name in batch]
+                await self.bot.outbound.run(lane, channel.send("Attachments from your archived channel:", files=files), guild=channel.guild)
+            shutil.rmtree(files_dir, ignore_errors=True)
+        os.remove(path)
+        self.metrics.incr("channel_archive.restored")
+        return True
@@ -0,0 +1,99 @@
+import asyncio
+import time
+from collections import deque
+
+# Joins within BURST_WINDOW seconds that switch provisioning into burst mode
+BURST_THRESHOLD = 10
+BURST_WINDOW = 60.0
+# Burst mode ends once the join rate falls to this fraction of the threshold
+BURST_EXIT_RATIO = 0.5
+# Pause between queued channel creations, leaving the rate limit room for everything else
+DRAIN_INTERVAL = 2.0
+
+
+class ChannelProvisioner:
+    def __init__(self, bot, create_channel, threshold=BURST_THRESHOLD, window=BURST_WINDOW, drain_interval=DRAIN_INTERVAL):
+        self.bot = bot
+        self.metrics = bot.metrics
+        # create_channel(member, user_key, *args) creates and records one private channel
+        self.create_channel = create_channel
+        self.threshold = threshold
+        self.window = window
+        self.drain_interval = drain_interval
+        # Everything below is per guild: Discord rate-limits channel creation per guild,
+        # so a raid on one server must not slow onboarding on another
+        # guild_id -> join timestamps inside the window
+        self._joins = {}
+        self._bursting = set()
+        # guild_id -> {member_id: (member, user_key, args)}, oldest first
+        self._queues = {}
+        self._drainers = {}
+
+    def bursting(self, guild):
+        if guild.id in self._bursting:
+            # Joins age out of the window with no event to notice it, so re-check on every query
+            self._update_mode(guild, time.monotonic())
+        return guild.id in self._bursting
+
+    def pending(self, guild):
+        return len(self._queues.get(guild.id, ()))
+
+    def _update_mode(self, guild, now):
+        joins = self._joins.setdefault(guild.id, deque())
+        while joins and now - joins[0] > self.window:
+            joins.popleft()
+        rate = len(joins)
+        if guild.id not in self._bursting and rate >= self.threshold:
+            self._bursting.add(guild.id)
+            self.metrics.incr("join_burst.entered")
+            print(f"Join burst detected in {guild} ({rate} joins in {self.window:.0f}s): queueing private channels")
+        elif guild.id in self._bursting and rate <= self.threshold * BURST_EXIT_RATIO:
+            self._bursting.discard(guild.id)
+            print(f"Join burst over in {guild}: creating private channels immediately again")
+        if not joins:
+            del self._joins[guild.id]
+
+    def record_join(self, guild):
+        now = time.monotonic()
+        self._joins.setdefault(guild.id, deque()).append(now)
+        self._update_mode(guild, now)
+
+    async def provision(self, member, user_key, *args):
+        # Outside a burst the channel is created now; during one, or while earlier joins
+        # are still queued, it waits its turn in the guild's background queue
+        guild = member.guild
+        if not self.bursting(guild) and not self.pending(guild):
+            await self.create_channel(member, user_key, *args)
+            return
+        self._queues.setdefault(guild.id, {})[member.id] = (member, user_key, args)
+        self.metrics.incr("channel_provision.queued")
+        if guild.id not in self._drainers:
+            self._drainers[guild.id] = asyncio.create_task(self._drain(guild))
+
+    def cancel(self, guild, member_id):
+        # The member left before their channel was created
+        queue = self._queues.get(guild.id)
+        if queue:
+            queue.pop(member_id, None)
+
+    async def _drain(self, guild):
+        queue = self._queues[guild.id]
+        try:
+            while queue:
+                member, user_key, args = queue.pop(next(iter(queue)))
+                if self._still_wanted(member, user_key):
+                    try:
+                        await self.create_channel(member, user_key, *args)
+                    except Exception as e:
+                        print(f"Error creating queued channel for {member}: {e}")
+                await asyncio.sleep(self.drain_interval)
+                self._update_mode(guild, time.monotonic())
+        finally:
+            del self._drainers[guild.id]
+            if not queue:
+                self._queues.pop(guild.id, None)
+
+    def _still_wanted(self, member, user_key):
+        # Members who left were already dropped by cancel(); the member cache may not hold anyone
+        record = self.bot.guild_states.user_store(member.guild).get(user_key)
+        return record is not None and not record.get("channel_id")
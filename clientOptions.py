@@ -0,0 +1,64 @@
+import os
+import discord
+
+# Chosen in .env: INTENT_PROFILE, MEMBER_CACHE and CHUNK_GUILDS_AT_STARTUP
+DEFAULT_INTENT_PROFILE = 'minimal'
+DEFAULT_MEMBER_CACHE = 'joined'
+
+
+def minimal_intents():
+    # Only the events the bot handles
+    intents = discord.Intents.none()
+    # Channels, threads and roles
+    intents.guilds = True
+    # Joins and leaves, and member lookups for commands
+    intents.members = True
+    # The channel gate and prefix commands; DMs are ignored, so no dm_messages
+    intents.guild_messages = True
+    intents.message_content = True
+    return intents
+
+
+def default_intents():
+    # discord.py's defaults (no presences) plus the privileged intents the bot needs
+    intents = discord.Intents.default()
+    intents.members = True
+    intents.message_content = True
+    return intents
+
+
+INTENT_PROFILES = {
+    'minimal': minimal_intents,
+    'default': default_intents,
+    'all': discord.Intents.all,
+}
+
+
+def member_cache_flags(policy, intents):
+    if policy == 'all':
+        return discord.MemberCacheFlags.from_intents(intents)
+    flags = discord.MemberCacheFlags.none()
+    if policy == 'joined':
+        # Members who join or are fetched while the bot runs, plus the few sent with each guild
+        flags.joined = True
+    elif policy != 'none':
+        raise ValueError(f"Unknown MEMBER_CACHE {policy!r}; use all, joined or none")
+    return flags
+
+
+def client_options(profile=None, cache_policy=None, chunk=None):
+    # Keyword arguments for the bot's constructor; anything not given is read from the environment
+    profile = profile or os.getenv('INTENT_PROFILE', DEFAULT_INTENT_PROFILE)
+    cache_policy = cache_policy or os.getenv('MEMBER_CACHE', DEFAULT_MEMBER_CACHE)
+    if profile not in INTENT_PROFILES:
+        raise ValueError(f"Unknown INTENT_PROFILE {profile!r}; use {', '.join(INTENT_PROFILES)}")
+    intents = INTENT_PROFILES[profile]()
+    if chunk is None:
+        chunk = os.getenv('CHUNK_GUILDS_AT_STARTUP')
+        # Downloading every member only pays off when they are all kept
+        chunk = chunk == '1' if chunk is not None else cache_policy == 'all'
+    return {
+        "intents": intents,
+        "member_cache_flags": member_cache_flags(cache_policy, intents),
+        "chunk_guilds_at_startup": chunk,
+    }
@@ -0,0 +1,88 @@
+import asyncio
+import threading
+from multiprocessing.connection import Client
+
+# Ops the launcher can send to every cluster process
+RELOAD_CONFIG = "reload_config"
+STATUS = "status"
+SHUTDOWN = "shutdown"
+
+# Discord lets each rate limit bucket (shard_id % max_concurrency) identify one shard
+# per IDENTIFY_INTERVAL seconds
+IDENTIFY_INTERVAL = 5.0
+
+
+def identify_slot(shard_id, max_concurrency):
+    # Shards in the same slot are all in different buckets, so they may identify together
+    return shard_id // max_concurrency
+
+
+class ClusterLink:
+    # A cluster process's connection to the launcher; requests arrive as {"id", "op"}
+    # and every request gets one {"id", "cluster", "result"} reply
+    def __init__(self, bot, address, authkey, cluster_id):
+        self.bot = bot
+        self.address = address
+        self.authkey = authkey
+        self.cluster_id = cluster_id
+        self._conn = None
+        self._task = None
+        self._handlers = {
+            RELOAD_CONFIG: self._reload_config,
+            STATUS: self._status,
+            SHUTDOWN: self._shutdown,
+        }
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._connect())
+
+    async def _connect(self):
+        try:
+            self._conn = await asyncio.to_thread(Client, self.address, authkey=self.authkey)
+        except OSError as e:
+            print(f"Cluster {self.cluster_id}: could not reach the launcher at {self.address}: {e}")
+            return
+        self._conn.send({"op": "hello", "cluster": self.cluster_id})
+        # A daemon thread, not the loop's executor, blocks on recv: an executor thread
+        # would keep the process from exiting after the bot closes
+        loop = asyncio.get_running_loop()
+        threading.Thread(target=self._read, args=(loop,), daemon=True).start()
+
+    def _read(self, loop):
+        while True:
+            try:
+                request = self._conn.recv()
+            except (EOFError, OSError):
+                print(f"Cluster {self.cluster_id}: launcher connection closed")
+                return
+            try:
+                asyncio.run_coroutine_threadsafe(self._handle(request), loop)
+            except RuntimeError:
+                # The loop is already closed
+                return
+
+    async def _handle(self, request):
+        handler = self._handlers.get(request.get("op"))
+        try:
+            result = await handler(request) if handler else {"error": f"unknown op {request.get('op')}"}
+        except Exception as e:
+            result = {"error": str(e)}
+        self._conn.send({"id": request.get("id"), "cluster": self.cluster_id, "result": result})
+
+    async def _reload_config(self, request):
+        return {"reloaded": self.bot.guild_states.reload()}
+
+    async def _status(self, request):
+        return {
+            "shards": sorted(self.bot.shards) if hasattr(self.bot, "shards") else None,
+            "guilds": len(self.bot.guilds),
+            "loaded_guilds": sum(1 for _ in self.bot.guild_states.loaded()),
+            "latency_ms": round(self.bot.latency * 1000) if self.bot.latency == self.bot.latency else None,
+            "metrics": self.bot.metrics.snapshot(),
+        }
+
+    async def _shutdown(self, request):
+        # The task starts after the reply is sent; closing the bot ends this process
+        asyncio.create_task(self.bot.close())
+        return {"closing": True}
@@ -1,15 +1,17 @@
 import os
 
-# File paths
+# Per-guild state lives in GUILDS_DIR/<guild_id>/, under the file names below
+GUILDS_DIR = 'guilds'
+
+# File names
 USER_IDS_FILE = 'user_ids.json'
+USER_DB_FILE = 'users.db'
+USER_JOURNAL_FILE = 'users.journal.jsonl'
 CONFIG_FILE = 'config.json'
 INFOS_FILE = 'infos.json'
+ARCHIVE_DIR = 'archives'
 
-# Globals to be set from infos.json
-ALLOWED_CATEGORY_ID = None
-ALLOWED_ROLE_ID = []
-SUPER_ADMIN_ROLE_ID = None
-MEMBER_ROLE_ID = []
+# Role and category settings live in each guild's infos.json and are served by configCache.ConfigCache (bot.guild_states.config(guild))
 
 WELCOME_MESSAGE = """```
 🌟 Welcome to the Server! 🌟
@@ -0,0 +1,187 @@
+import asyncio
+import json
+import os
+
+DEFAULT_INFOS = {
+    "admin_roles": [],
+    "super_admin_role": None,
+    "member_roles": [],
+    "allowed_category": None,
+    # Categories created when the allowed category is full, in fill order
+    "overflow_categories": []
+}
+
+# Spare private channels kept ready per guild, and seconds between creating two spares
+DEFAULT_SPARE_POOL_SIZE = 0
+DEFAULT_SPARE_POOL_REFILL_SECONDS = 30
+
+# How often to check the files for edits made outside the bot
+POLL_INTERVAL = 5.0
+
+
+class ConfigCache:
+    def __init__(self, infos_path, config_path, poll_interval=POLL_INTERVAL, guild_id=None):
+        self.guild_id = guild_id
+        self.infos_path = infos_path
+        self.config_path = config_path
+        self.poll_interval = poll_interval
+        self.infos = dict(DEFAULT_INFOS)
+        self.config = {}
+        # Bumped on every change so callers can tell when derived data is stale
+        self.version = 0
+        self._mtimes = {}
+        self._watch_task = None
+        self._subscribers = []
+        self.load()
+
+    @property
+    def admin_roles(self):
+        return self.infos.get("admin_roles", [])
+
+    @property
+    def member_roles(self):
+        return self.infos.get("member_roles", [])
+
+    @property
+    def super_admin_role(self):
+        return self.infos.get("super_admin_role")
+
+    @property
+    def allowed_category(self):
+        return self.infos.get("allowed_category")
+
+    @property
+    def overflow_categories(self):
+        return self.infos.get("overflow_categories", [])
+
+    @property
+    def allowed_categories(self):
+        # The allowed category and its overflow categories, in fill order
+        return self._allowed_categories
+
+    def is_allowed_category(self, category_id):
+        return category_id is not None and category_id in self._allowed_category_set
+
+    @property
+    def welcome_channel(self):
+        return self.config.get("welcome_channel")
+
+    @property
+    def thread_mode(self):
+        # Private spaces are private threads in the hub channel instead of channels
+        return self.config.get("private_spaces") == "threads" and self.thread_hub is not None
+
+    @property
+    def thread_hub(self):
+        return self.config.get("thread_hub")
+
+    @property
+    def spare_pool_size(self):
+        return self.config.get("spare_pool_size", DEFAULT_SPARE_POOL_SIZE)
+
+    @property
+    def spare_pool_refill_seconds(self):
+        return self.config.get("spare_pool_refill_seconds", DEFAULT_SPARE_POOL_REFILL_SECONDS)
+
+    @property
+    def archive_idle_days(self):
+        # Private channels idle this long are exported and deleted; 0 keeps them forever
+        return self.config.get("archive_idle_days", 0)
+
+    @property
+    def max_live_channels(self):
+        # Most private channels kept at once; the least recently used are archived first. 0 is unlimited
+        return self.config.get("max_live_channels", 0)
+
+    @property
+    def lazy_channels(self):
+        # Create private channels on first use instead of on join
+        return bool(self.config.get("lazy_channels", False))
+
+    def _mtime(self, path):
+        try:
+            return os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _read(self, path, default):
+        try:
+            with open(path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            self._write(path, default)
+            print(f"Created {path}")
+            return dict(default)
+
+    def _write(self, path, data):
+        # Write to a temp file and rename so a crash never leaves a half-written file
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, indent=4)
+        os.replace(tmp_path, path)
+        self._mtimes[path] = self._mtime(path)
+
+    def load(self):
+        infos = self._read(self.infos_path, DEFAULT_INFOS)
+        config = self._read(self.config_path, {})
+        self.infos = {**DEFAULT_INFOS, **infos}
+        self.config = config
+        self._mtimes[self.infos_path] = self._mtime(self.infos_path)
+        self._mtimes[self.config_path] = self._mtime(self.config_path)
+        self._publish()
+
+    def update_infos(self, **changes):
+        infos = {**self.infos, **changes}
+        self._write(self.infos_path, infos)
+        self.infos = infos
+        self._publish()
+
+    def update_config(self, **changes):
+        config = {**self.config, **changes}
+        self._write(self.config_path, config)
+        self.config = config
+        self._publish()
+
+    def subscribe(self, callback):
+        # callback(config) runs once after every change, so derived data is rebuilt per change, not per use
+        self._subscribers.append(callback)
+
+    def _publish(self):
+        self.version += 1
+        allowed = [self.allowed_category] if self.allowed_category else []
+        self._allowed_categories = tuple(allowed + [category_id for category_id in self.overflow_categories if category_id not in allowed])
+        self._allowed_category_set = frozenset(self._allowed_categories)
+        for callback in self._subscribers:
+            try:
+                callback(self)
+            except Exception as e:
+                print(f"Error in config change subscriber {callback!r}: {e}")
+
+    def check_for_changes(self):
+        changed = [path for path in (self.infos_path, self.config_path) if self._mtime(path) != self._mtimes.get(path)]
+        if not changed:
+            return False
+        try:
+            self.load()
+        except Exception as e:
+            # Keep serving the last good snapshot if the edited file doesn't parse
+            print(f"Error reloading config after external edit: {e}")
+            for path in changed:
+                self._mtimes[path] = self._mtime(path)
+            return False
+        print(f"Reloaded config after external edit of {', '.join(changed)}")
+        return True
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            self.check_for_changes()
+
+    def start_watching(self):
+        if self._watch_task is None or self._watch_task.done():
+            self._watch_task = asyncio.get_running_loop().create_task(self._watch())
+
+    def stop_watching(self):
+        if self._watch_task is not None:
+            self._watch_task.cancel()
+            self._watch_task = None
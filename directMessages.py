@@ -0,0 +1,49 @@
+import time
+import discord
+from outboundScheduler import BACKGROUND
+
+# How long a user whose DMs are closed is skipped before trying again
+CLOSED_DM_TTL = 6 * 60 * 60
+# Discord error code for "Cannot send messages to this user"
+CANNOT_MESSAGE_USER = 50007
+
+
+class DirectMessenger:
+    def __init__(self, bot, ttl=CLOSED_DM_TTL):
+        self.bot = bot
+        self.metrics = bot.metrics
+        self.ttl = ttl
+        # user_id -> monotonic time until which DMs to that user are skipped
+        self._closed = {}
+
+    def is_closed(self, user):
+        until = self._closed.get(user.id)
+        if until is None:
+            return False
+        if time.monotonic() >= until:
+            del self._closed[user.id]
+            return False
+        return True
+
+    async def send(self, user, content, lane=BACKGROUND):
+        # Returns True if the DM was delivered; users known to have DMs closed are skipped
+        if self.is_closed(user):
+            self.metrics.incr("dm_closed_cache.hit")
+            return False
+        self.metrics.incr("dm_closed_cache.miss")
+        try:
+            await self.bot.outbound.run(lane, user.send(content), guild=getattr(user, 'guild', None))
+            return True
+        except discord.Forbidden as e:
+            if e.code == CANNOT_MESSAGE_USER:
+                self._prune()
+                self._closed[user.id] = time.monotonic() + self.ttl
+                self.metrics.incr("dm_closed_cache.added")
+            return False
+        except discord.HTTPException:
+            return False
+
+    def _prune(self):
+        now = time.monotonic()
+        for user_id in [user_id for user_id, until in self._closed.items() if until <= now]:
+            del self._closed[user_id]
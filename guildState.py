@@ -0,0 +1,169 @@
+import os
+from config import GUILDS_DIR, USER_IDS_FILE, USER_DB_FILE, USER_JOURNAL_FILE, CONFIG_FILE, INFOS_FILE, ARCHIVE_DIR
+from userStore import UserStore
+from configCache import ConfigCache
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+# Held while a process has the guild loaded, so two cluster processes never share a store
+LOCK_FILE = '.lock'
+# Held in the guilds directory for each shard a process runs, from startup
+SHARD_LOCK_FILE = '.shard-{shard_count}-{shard_id}.lock'
+
+# Single-server files from before state was split per guild, adopted by the first guild
+LEGACY_FILES = (INFOS_FILE, CONFIG_FILE, USER_DB_FILE, USER_DB_FILE + "-wal", USER_DB_FILE + "-shm",
+                USER_JOURNAL_FILE, USER_IDS_FILE, USER_IDS_FILE + ".imported")
+
+
+def acquire_lock(path, name):
+    # Exclusive until the returned file is closed; name says what the lock guards in the error
+    lock = open(path, 'a+')
+    try:
+        if fcntl:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            lock.seek(0)
+            msvcrt.locking(lock.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        lock.close()
+        raise RuntimeError(f"{name} is in use by another process; is the shard layout overlapping?")
+    return lock
+
+
+class GuildState:
+    def __init__(self, guild_id, path):
+        self.guild_id = guild_id
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self._lock = acquire_lock(os.path.join(path, LOCK_FILE), path)
+        self.config = ConfigCache(os.path.join(path, INFOS_FILE), os.path.join(path, CONFIG_FILE), guild_id=guild_id)
+        self.user_store = UserStore(os.path.join(path, USER_DB_FILE), os.path.join(path, USER_JOURNAL_FILE))
+        self.archive_dir = os.path.join(path, ARCHIVE_DIR)
+
+    def close(self):
+        self.config.stop_watching()
+        self.user_store.close()
+        # Closing the file releases the lock
+        self._lock.close()
+
+
+class GuildStates:
+    def __init__(self, bot, base_dir=GUILDS_DIR):
+        self.bot = bot
+        self.base_dir = base_dir
+        # guild_id -> GuildState, loaded on the guild's first event
+        self._states = {}
+        self._subscribers = []
+        self._shard_locks = []
+        # While single-server files wait for adopt_legacy, no guild may load: loading would
+        # create an empty guild directory and the old users would never be adopted
+        self._legacy_pending = any(os.path.exists(name) for name in LEGACY_FILES)
+
+    def _path(self, guild_id):
+        return os.path.join(self.base_dir, str(guild_id))
+
+    def get(self, guild):
+        state = self._states.get(guild.id)
+        if state is None:
+            state = self._load(guild)
+        return state
+
+    def config(self, guild):
+        return self.get(guild).config
+
+    def user_store(self, guild):
+        return self.get(guild).user_store
+
+    def loaded(self):
+        # (guild, state) for guilds whose state is in memory; background jobs only visit these
+        for guild_id, state in list(self._states.items()):
+            guild = self.bot.get_guild(guild_id)
+            if guild:
+                yield guild, state
+
+    def _load(self, guild):
+        if self._legacy_pending:
+            raise RuntimeError(f"State for {guild} is not available until single-server data has been adopted")
+        state = self._states[guild.id] = GuildState(guild.id, self._path(guild.id))
+        for callback in self._subscribers:
+            state.config.subscribe(callback)
+        state.config.start_watching()
+        try:
+            imported = state.user_store.import_json(os.path.join(state.path, USER_IDS_FILE))
+            if imported:
+                print(f"Imported {imported} users from {USER_IDS_FILE} for {guild}")
+        except Exception as e:
+            print(f"Error importing {USER_IDS_FILE} for {guild}: {e}")
+        # Lets listeners index the guild's channels once its state exists
+        self.bot.dispatch("guild_state_load", guild, state)
+        return state
+
+    def reload(self):
+        # Re-read every loaded guild's config files, for edits made while the watcher was off
+        reloaded = 0
+        for guild_id, state in list(self._states.items()):
+            try:
+                state.config.load()
+                reloaded += 1
+            except Exception as e:
+                print(f"Error reloading config for guild {guild_id}: {e}")
+        return reloaded
+
+    def subscribe(self, callback):
+        # callback(config) after every change of any guild's config; config.guild_id says which
+        self._subscribers.append(callback)
+        for state in self._states.values():
+            state.config.subscribe(callback)
+
+    def adopt_legacy(self, guilds, sharded=False):
+        # Move the old single-server files into the guild they belonged to. Only safe
+        # when the bot is in exactly one guild; otherwise leave them for an operator.
+        # Guilds can load once this has run, whatever the outcome.
+        self._legacy_pending = False
+        legacy = [name for name in LEGACY_FILES if os.path.exists(name)]
+        if not legacy:
+            return None
+        if sharded or len(guilds) != 1:
+            reason = "the bot runs several shards" if sharded else f"the bot is in {len(guilds)} guilds"
+            print(f"WARNING: found single-server data ({', '.join(legacy)}) but {reason}; "
+                  f"it was NOT adopted. Move it into {self.base_dir}/<guild_id>/ by hand")
+            return None
+        guild = guilds[0]
+        path = self._path(guild.id)
+        if guild.id in self._states or os.path.exists(path):
+            print(f"WARNING: found single-server data ({', '.join(legacy)}) but {path} already exists; "
+                  f"it was NOT adopted. Merge it by hand")
+            return None
+        os.makedirs(path)
+        for name in legacy:
+            os.replace(name, os.path.join(path, name))
+        if os.path.isdir(ARCHIVE_DIR):
+            os.replace(ARCHIVE_DIR, os.path.join(path, ARCHIVE_DIR))
+        print(f"Moved single-server data into {path} for {guild}")
+        return guild
+
+    def lock_shards(self, shard_count, shard_ids):
+        # Refuse to start when another process already runs one of these shards. Only processes
+        # with the same shard count can be compared; the guild locks catch any other overlap
+        # when the second process loads a shared guild.
+        os.makedirs(self.base_dir, exist_ok=True)
+        for shard_id in shard_ids:
+            path = os.path.join(self.base_dir, SHARD_LOCK_FILE.format(shard_count=shard_count, shard_id=shard_id))
+            self._shard_locks.append(acquire_lock(path, f"Shard {shard_id} of {shard_count}"))
+
+    def unload(self, guild_id):
+        state = self._states.pop(guild_id, None)
+        if state:
+            state.close()
+
+    def close(self):
+        for guild_id in list(self._states):
+            self.unload(guild_id)
+        for lock in self._shard_locks:
+            lock.close()
+        self._shard_locks = []
@@ -0,0 +1,252 @@
+import argparse
+import itertools
+import json
+import os
+import secrets
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+from multiprocessing.connection import Listener, Client
+from dotenv import load_dotenv
+
+from clusterLink import RELOAD_CONFIG, STATUS, SHUTDOWN, IDENTIFY_INTERVAL, identify_slot
+
+IPC_HOST = '127.0.0.1'
+IPC_PORT = 47110
+# Seconds to wait for every cluster to answer a command
+REPLY_TIMEOUT = 10.0
+# A cluster that exits is restarted after this many seconds, doubling up to the maximum
+RESTART_DELAY = 5.0
+MAX_RESTART_DELAY = 300.0
+GATEWAY_URL = 'https://discord.com/api/v10/gateway/bot'
+
+BOT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'masker.py')
+
+
+def bot_gateway(token):
+    # Recommended shard count and session start limits, including max_concurrency
+    request = urllib.request.Request(GATEWAY_URL, headers={
+        "Authorization": f"Bot {token}",
+        "User-Agent": "MaskerBot launcher",
+    })
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return json.load(response)
+
+
+def shard_ranges(shard_count, processes):
+    # Contiguous shard ranges, as even as possible; a guild always lives on exactly one shard,
+    # so each process only ever opens its own guilds' stores under guilds/
+    processes = max(1, min(processes, shard_count))
+    size, extra = divmod(shard_count, processes)
+    ranges, start = [], 0
+    for index in range(processes):
+        end = start + size + (1 if index < extra else 0)
+        ranges.append(list(range(start, end)))
+        start = end
+    return ranges
+
+
+class Cluster:
+    def __init__(self, cluster_id, shard_ids):
+        self.cluster_id = cluster_id
+        self.shard_ids = shard_ids
+        self.process = None
+        self.conn = None
+        self.started = 0.0
+        # When the cluster is due to be started or restarted; None while it runs
+        self.restart_at = None
+        # Wall-clock time at which its first shard may identify; None to identify right away
+        self.identify_at = None
+        self.restart_delay = RESTART_DELAY
+
+
+class Launcher:
+    def __init__(self, shard_count, processes, address, authkey, max_concurrency=1):
+        self.shard_count = shard_count
+        self.max_concurrency = max_concurrency
+        self.address = address
+        self.authkey = authkey
+        self.clusters = [Cluster(index, shard_ids) for index, shard_ids in enumerate(shard_ranges(shard_count, processes))]
+        self.listener = Listener(address, authkey=authkey)
+        self._lock = threading.Lock()
+        self._request_ids = itertools.count(1)
+        # request id -> (replies, event set once every cluster answered, clusters asked)
+        self._requests = {}
+        self._stopping = False
+        self._shutdown_sent = False
+
+    def start_cluster(self, cluster):
+        env = dict(os.environ,
+                   SHARD_COUNT=str(self.shard_count),
+                   SHARD_IDS=",".join(str(shard_id) for shard_id in cluster.shard_ids),
+                   CLUSTER_ID=str(cluster.cluster_id),
+                   MASKER_IPC_ADDRESS=f"{self.address[0]}:{self.address[1]}",
+                   MASKER_IPC_KEY=self.authkey.decode(),
+                   MASKER_IDENTIFY_AT=str(cluster.identify_at or time.time()),
+                   MASKER_MAX_CONCURRENCY=str(self.max_concurrency))
+        # Own session on POSIX, so Ctrl-C reaches only the launcher, which then shuts clusters down in order
+        cluster.process = subprocess.Popen([sys.executable, BOT_SCRIPT], env=env, start_new_session=os.name == 'posix')
+        cluster.started = time.monotonic()
+        # Only the first start follows the launch schedule; a restarted cluster identifies as soon as it is up
+        cluster.identify_at = None
+        print(f"Started cluster {cluster.cluster_id} (pid {cluster.process.pid}) with shards {cluster.shard_ids}")
+
+    def _accept(self):
+        while True:
+            try:
+                conn = self.listener.accept()
+            except OSError:
+                # Listener closed on shutdown, or a client failed authentication
+                if self._stopping:
+                    return
+                continue
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        # The first message says who is calling: a cluster process, or `launcher.py send`
+        try:
+            hello = conn.recv()
+        except (EOFError, OSError):
+            return
+        if hello.get("op") == "hello":
+            self._serve_cluster(conn, self.clusters[hello["cluster"]])
+        elif hello.get("op") == "command":
+            if hello["command"] == SHUTDOWN:
+                # Don't restart the clusters as they exit; run() then stops the launcher
+                self._stopping = True
+                self._shutdown_sent = True
+            conn.send(self.broadcast(hello["command"]))
+            conn.close()
+
+    def _serve_cluster(self, conn, cluster):
+        with self._lock:
+            cluster.conn = conn
+        print(f"Cluster {cluster.cluster_id} connected")
+        while True:
+            try:
+                reply = conn.recv()
+            except (EOFError, OSError):
+                break
+            with self._lock:
+                request = self._requests.get(reply.get("id"))
+            if request:
+                replies, done, expected = request
+                replies[reply["cluster"]] = reply["result"]
+                if len(replies) >= expected:
+                    done.set()
+        with self._lock:
+            if cluster.conn is conn:
+                cluster.conn = None
+
+    def broadcast(self, op):
+        # Send op to every connected cluster and collect {cluster_id: result}
+        request_id = next(self._request_ids)
+        with self._lock:
+            connected = [cluster for cluster in self.clusters if cluster.conn is not None]
+            replies, done = {}, threading.Event()
+            self._requests[request_id] = (replies, done, len(connected))
+        for cluster in connected:
+            try:
+                cluster.conn.send({"id": request_id, "op": op})
+            except OSError:
+                replies[cluster.cluster_id] = {"error": "not connected"}
+        if connected:
+            done.wait(REPLY_TIMEOUT)
+        with self._lock:
+            del self._requests[request_id]
+        for cluster in self.clusters:
+            replies.setdefault(cluster.cluster_id, {"error": "no reply"})
+        return replies
+
+    def run(self):
+        # Each cluster starts when its first shard's identify slot comes up, one interval early so it
+        # has time to log in; its shards then identify in their slots (see MaskerBot.before_identify_hook)
+        now, wall = time.monotonic(), time.time()
+        for cluster in self.clusters:
+            slot = identify_slot(cluster.shard_ids[0], self.max_concurrency)
+            cluster.restart_at = now + IDENTIFY_INTERVAL * slot
+            cluster.identify_at = wall + IDENTIFY_INTERVAL * (slot + 1)
+        print(f"Starting {len(self.clusters)} clusters over {IDENTIFY_INTERVAL * slot:.0f}s (max_concurrency {self.max_concurrency})")
+        threading.Thread(target=self._accept, daemon=True).start()
+        try:
+            while not self._stopping:
+                time.sleep(1)
+                self._supervise()
+        except KeyboardInterrupt:
+            print("Shutting down clusters")
+        finally:
+            self.stop()
+
+    def _supervise(self):
+        now = time.monotonic()
+        for cluster in self.clusters:
+            if cluster.restart_at is not None:
+                if now >= cluster.restart_at:
+                    cluster.restart_at = None
+                    self.start_cluster(cluster)
+                continue
+            code = cluster.process.poll()
+            if code is None:
+                if now - cluster.started > MAX_RESTART_DELAY:
+                    # Stayed up long enough: the next crash restarts quickly again
+                    cluster.restart_delay = RESTART_DELAY
+            else:
+                cluster.restart_at = now + cluster.restart_delay
+                print(f"Cluster {cluster.cluster_id} exited with code {code}; restarting in {cluster.restart_delay:.0f}s")
+                cluster.restart_delay = min(cluster.restart_delay * 2, MAX_RESTART_DELAY)
+
+    def stop(self):
+        self._stopping = True
+        # Let every cluster close its gateway connections and fold its journals first
+        if not self._shutdown_sent:
+            self.broadcast(SHUTDOWN)
+        for cluster in self.clusters:
+            if cluster.process is None:
+                continue
+            try:
+                cluster.process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                cluster.process.terminate()
+        self.listener.close()
+
+
+def send_command(address, authkey, op):
+    conn = Client(address, authkey=authkey)
+    conn.send({"op": "command", "command": op})
+    replies = conn.recv()
+    conn.close()
+    for cluster_id, result in sorted(replies.items()):
+        print(f"cluster {cluster_id}: {json.dumps(result)}")
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Run MaskerBot as several processes, each with a range of shards")
+    parser.add_argument("--port", type=int, default=IPC_PORT, help="local port for the launcher's command channel")
+    subcommands = parser.add_subparsers(dest="action", required=True)
+    run = subcommands.add_parser("run", help="start the clusters and keep them running")
+    run.add_argument("--processes", type=int, default=os.cpu_count() or 1)
+    run.add_argument("--shards", type=int, help="total shard count (default: Discord's recommendation)")
+    send = subcommands.add_parser("send", help="send a command to every cluster of a running launcher")
+    send.add_argument("command", choices=[RELOAD_CONFIG, STATUS, SHUTDOWN])
+    args = parser.parse_args()
+
+    address = (IPC_HOST, args.port)
+    if args.action == "send":
+        authkey = os.getenv('MASKER_IPC_KEY')
+        if not authkey:
+            sys.exit("MASKER_IPC_KEY must be set to the launcher's key")
+        send_command(address, authkey.encode(), args.command)
+        return
+
+    # Without a configured key, only the clusters themselves can use the command channel
+    authkey = os.getenv('MASKER_IPC_KEY') or secrets.token_hex(16)
+    gateway = bot_gateway(os.getenv('DISCORD_TOKEN'))
+    shard_count = args.shards or gateway["shards"]
+    Launcher(shard_count, args.processes, address, authkey.encode(), gateway["session_start_limit"]["max_concurrency"]).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,29 @@
 import discord
+import asyncio
+import time
 import os
-import json
-import random
-import string
-import datetime
 import aiohttp
 import io
 from dotenv import load_dotenv
 from discord.ext import commands
-from config import USER_IDS_FILE, CONFIG_FILE, INFOS_FILE, ALLOWED_CATEGORY_ID, ALLOWED_ROLE_ID, SUPER_ADMIN_ROLE_ID, MEMBER_ROLE_ID, WELCOME_MESSAGE
+from config import WELCOME_MESSAGE
+
+from guildState import GuildStates
+from permissions import PermissionResolver, NONE
+from webhookPool import WebhookPool
+from attachmentRelay import AttachmentRelay
+from privateChannels import PrivateChannels, RULES_MESSAGE
+from purgeEngine import PurgeEngine
+from channelProvisioner import ChannelProvisioner
+from spareChannelPool import SpareChannelPool
+from channelArchiver import ChannelArchiver
+from moderationQueue import ModerationQueue
+from metrics import Metrics
+from outboundScheduler import OutboundScheduler, INTERACTIVE, BACKGROUND
+from directMessages import DirectMessenger
+from clusterLink import ClusterLink, IDENTIFY_INTERVAL, identify_slot
+from clientOptions import client_options
+from memberLookup import MemberLookup
 
 import memberCmd
 import adminCmd
@@ -16,33 +31,101 @@ import superAdminCmd
 
 load_dotenv()
 
-client = commands.Bot(command_prefix="MM ", intents=discord.Intents.all())
+# Sharding is opt-in: SHARDED=1 lets discord.py pick the shard count, SHARD_COUNT/SHARD_IDS pin it.
+# launcher.py sets these (plus CLUSTER_ID and the IPC address) for each process it starts.
+SHARD_COUNT = int(os.getenv('SHARD_COUNT')) if os.getenv('SHARD_COUNT') else None
+SHARD_IDS = [int(shard_id) for shard_id in os.getenv('SHARD_IDS').split(',')] if os.getenv('SHARD_IDS') else None
+SHARDED = os.getenv('SHARDED') == '1' or SHARD_COUNT is not None or SHARD_IDS is not None
+CLUSTER_ID = int(os.getenv('CLUSTER_ID', '0'))
+IPC_ADDRESS = os.getenv('MASKER_IPC_ADDRESS')
+# Wall-clock time at which this cluster's first shard may identify, and Discord's max_concurrency
+IDENTIFY_AT = float(os.getenv('MASKER_IDENTIFY_AT', '0'))
+MAX_CONCURRENCY = int(os.getenv('MASKER_MAX_CONCURRENCY', '1'))
+
+class MaskerContext(commands.Context):
+    async def send(self, *args, **kwargs):
+        # Command replies take the interactive lane, ahead of onboarding and moderation traffic
+        return await self.bot.outbound.run(INTERACTIVE, super().send(*args, **kwargs), guild=self.guild)
+
+class MaskerBot(commands.AutoShardedBot if SHARDED else commands.Bot):
+    async def get_context(self, origin, *, cls=MaskerContext):
+        return await super().get_context(origin, cls=cls)
+
+    async def setup_hook(self):
+        # One HTTP session for the bot's own downloads, reused across commands
+        self.http_session = aiohttp.ClientSession()
+        # Fail now rather than on a guild's first event if another process runs any of our shards.
+        # Unsharded and auto-sharded processes run every guild, which counts as shard 0 of 1.
+        if SHARD_COUNT:
+            self.guild_states.lock_shards(SHARD_COUNT, SHARD_IDS or range(SHARD_COUNT))
+        else:
+            self.guild_states.lock_shards(1, [0])
+        # Started by launcher.py: take commands such as config reloads from the launcher
+        if IPC_ADDRESS:
+            host, port = IPC_ADDRESS.rsplit(':', 1)
+            self.cluster_link = ClusterLink(self, (host, int(port)), os.getenv('MASKER_IPC_KEY', '').encode(), CLUSTER_ID)
+            self.cluster_link.start()
+
+    async def before_identify_hook(self, shard_id, *, initial=False):
+        # Started by launcher.py: a shard's first identify waits for its slot in the schedule every
+        # cluster shares, so the processes together stay within Discord's max_concurrency
+        if IDENTIFY_AT and shard_id not in self.scheduled_identifies:
+            self.scheduled_identifies.add(shard_id)
+            if self.identify_start is None:
+                # A process that came up late shifts its schedule rather than identifying in a burst
+                self.identify_start = max(IDENTIFY_AT, time.time())
+            slot = identify_slot(shard_id, MAX_CONCURRENCY) - identify_slot(SHARD_IDS[0], MAX_CONCURRENCY)
+            await asyncio.sleep(max(0.0, self.identify_start + IDENTIFY_INTERVAL * slot - time.time()))
+            return
+        await super().before_identify_hook(shard_id, initial=initial)
+
+    async def close(self):
+        await super().close()
+        if self.http_session is not None:
+            await self.http_session.close()
+
+shard_options = {"shard_count": SHARD_COUNT, "shard_ids": SHARD_IDS} if SHARDED else {}
+# Intents and member caching come from INTENT_PROFILE, MEMBER_CACHE and CHUNK_GUILDS_AT_STARTUP
+client = MaskerBot(command_prefix="MM ", **client_options(), **shard_options)
+client.http_session = None
+client.scheduled_identifies = set()
+client.identify_start = None
+client.metrics = Metrics()
+client.outbound = OutboundScheduler(client.metrics)
+# Config and users are kept per guild and loaded on each guild's first event
+client.guild_states = GuildStates(client)
+client.permissions = PermissionResolver(client.guild_states)
+# Most members aren't cached, so commands look them up through here
+client.member_lookup = MemberLookup(client)
+client.webhook_pool = WebhookPool(client)
+client.attachment_relay = AttachmentRelay(client)
+client.private_channels = PrivateChannels(client)
+client.purge_engine = PurgeEngine(client)
+client.spare_pool = SpareChannelPool(client)
+client.channel_archiver = ChannelArchiver(client)
+# Private channels are created right away, or queued and throttled during a join burst
+client.channel_provisioner = ChannelProvisioner(client, client.private_channels.create)
+client.direct_messages = DirectMessenger(client)
+client.moderation_queue = ModerationQueue(client)
 
 @client.check
 async def global_member_check(ctx):
-    # Reload infos to ensure up to date
-    try:
-        with open(INFOS_FILE, 'r') as f:
-            infos = json.load(f)
-        global ALLOWED_CATEGORY_ID, ALLOWED_ROLE_ID, SUPER_ADMIN_ROLE_ID, MEMBER_ROLE_ID
-        ALLOWED_CATEGORY_ID = infos.get("allowed_category")
-        ALLOWED_ROLE_ID = infos.get("admin_roles", [])
-        SUPER_ADMIN_ROLE_ID = infos.get("super_admin_role")
-        MEMBER_ROLE_ID = infos.get("member_roles", [])
-    except Exception as e:
-        print(f"Error reloading infos in global check: {e}")
+    # Commands act on one guild's state, so they can't run in DMs
+    if ctx.guild is None:
+        return False
+    # Read from the guild's cached config snapshot, kept current by the config commands and the file watcher
+    config = client.guild_states.config(ctx.guild)
+    super_admin_role_id = config.super_admin_role
 
     # Special case: allow setRole superadmin if no super admin role is set yet
-    if ctx.command and ctx.command.name == 'setRole' and SUPER_ADMIN_ROLE_ID is None and 'superadmin' in ctx.message.content.lower():
+    if ctx.command and ctx.command.name == 'setRole' and super_admin_role_id is None and 'superadmin' in ctx.message.content.lower():
         return True
     # Special case: allow helpDisplay for everyone
     if ctx.command and ctx.command.name == 'helpDisplay':
         return True
     # Allow if user has member role, admin role, or super admin role
-    is_owner = ctx.author == ctx.guild.owner
-    if is_owner or (any(role.id in MEMBER_ROLE_ID for role in ctx.author.roles) or
-        any(role.id in ALLOWED_ROLE_ID for role in ctx.author.roles) or
-        (SUPER_ADMIN_ROLE_ID and any(role.id == SUPER_ADMIN_ROLE_ID for role in ctx.author.roles))):
+    is_owner = ctx.author.id == ctx.guild.owner_id
+    if is_owner or client.permissions.tier(ctx.author) != NONE:
         return True
     else:
         embed = discord.Embed(
@@ -55,46 +138,19 @@ async def global_member_check(ctx):
 
 @client.event
 async def on_ready():
-    print(f'We have logged in as {client.user}')
-    # Ensure user_ids.json exists
-    try:
-        with open(USER_IDS_FILE, 'r') as f:
-            json.load(f)
-    except FileNotFoundError:
-        with open(USER_IDS_FILE, 'w') as f:
-            json.dump({}, f, indent=4)
-        print(f"Created {USER_IDS_FILE}")
-
-    # Ensure config.json exists
-    try:
-        with open(CONFIG_FILE, 'r') as f:
-            json.load(f)
-    except FileNotFoundError:
-        with open(CONFIG_FILE, 'w') as f:
-            json.dump({}, f, indent=4)
-        print(f"Created {CONFIG_FILE}")
-
-    # Ensure infos.json exists and load globals
-    try:
-        with open(INFOS_FILE, 'r') as f:
-            infos = json.load(f)
-    except FileNotFoundError:
-        infos = {
-            "admin_roles": [],
-            "super_admin_role": None,
-            "member_roles": [],
-            "allowed_category": None
-        }
-        with open(INFOS_FILE, 'w') as f:
-            json.dump(infos, f, indent=4)
-        print(f"Created {INFOS_FILE}")
-
-    # Set globals
-    global ALLOWED_CATEGORY_ID, ALLOWED_ROLE_ID, SUPER_ADMIN_ROLE_ID, MEMBER_ROLE_ID
-    ALLOWED_CATEGORY_ID = infos.get("allowed_category")
-    ALLOWED_ROLE_ID = infos.get("admin_roles", [])
-    SUPER_ADMIN_ROLE_ID = infos.get("super_admin_role")
-    MEMBER_ROLE_ID = infos.get("member_roles", [])
+    if SHARDED:
+        print(f'We have logged in as {client.user} (cluster {CLUSTER_ID}, shards {sorted(client.shards)} of {client.shard_count})')
+    else:
+        print(f'We have logged in as {client.user}')
+    # Data from before state was kept per guild belongs to the only guild the bot was in. With
+    # several shards this process only sees some guilds, so it can't tell that it is alone.
+    # Guild state can't load until this has run.
+    client.guild_states.adopt_legacy(client.guilds, sharded=(client.shard_count or 1) > 1)
+
+    # Keep spare private channels ready for the next joins
+    client.spare_pool.start()
+    # Archive private channels nobody has used in a while
+    client.channel_archiver.start()
 
     # Load cogs if not already loaded
     if not client.get_cog('MemberCmd'):
@@ -104,125 +160,123 @@ async def on_ready():
     if not client.get_cog('SuperAdminCmd'):
         await superAdminCmd.setup(client)
 
+@client.event
+async def on_guild_state_load(guild, state):
+    # Runs once per guild, on its first event: reuse the anonymous-post webhooks created by
+    # previous runs, and index private channels that predate channel IDs being recorded
+    await client.webhook_pool.discover(guild)
+    indexed = client.private_channels.backfill(guild)
+    if indexed:
+        print(f"Indexed {indexed} existing private channels in {guild}")
+    client.spare_pool.discover(guild)
+
+@client.event
+async def on_guild_remove(guild):
+    client.guild_states.unload(guild.id)
+
+async def send_welcome(member):
+    welcome_channel_id = client.guild_states.config(member.guild).welcome_channel
+    if not welcome_channel_id:
+        return
+    welcome_channel = member.guild.get_channel(welcome_channel_id)
+    if welcome_channel:
+        await client.outbound.run(BACKGROUND, welcome_channel.send(f"Welcome {member.mention} has joined the server!"), guild=member.guild)
+
+async def send_rules_dm(member, rules_message):
+    if not await client.direct_messages.send(member, rules_message):
+        print(f"Could not send DM to {member}")
+
 @client.event
 async def on_member_join(member):
-    # Load existing user IDs
-    try:
-        with open(USER_IDS_FILE, 'r') as f:
-            user_ids = json.load(f)
-    except FileNotFoundError:
-        user_ids = {}
+    started = time.monotonic()
+    user_store = client.guild_states.user_store(member.guild)
+    client.channel_provisioner.record_join(member.guild)
 
     # Generate unique user_id
-    existing_ids = set()
-    for data in user_ids.values():
-        if isinstance(data, dict):
-            existing_ids.add(data.get("user_id"))
-            if data.get("admin_id"):
-                existing_ids.add(data.get("admin_id"))
-        elif isinstance(data, str):
-            existing_ids.add(data)
-    user_id = ''.join(random.choices(string.ascii_letters + string.digits, k=12))
-    while user_id in existing_ids:
-        user_id = ''.join(random.choices(string.ascii_letters + string.digits, k=12))
+    user_id = user_store.allocate_id()
 
     # Determine role
-    role = "admin" if any(role.id in ALLOWED_ROLE_ID for role in member.roles) else "user"
+    role = "admin" if client.permissions.is_admin(member) else "user"
     admin_id = None
     if role == "admin":
-        admin_id = ''.join(random.choices(string.ascii_letters + string.digits, k=12))
-        while admin_id in existing_ids or admin_id == user_id:
-            admin_id = ''.join(random.choices(string.ascii_letters + string.digits, k=12))
-
-    # Save the data with username as key
-    user_ids[str(member)] = {
-        "user_id": user_id,
-        "role": role,
-        "admin_id": admin_id,
-        "role_history": [{"role": role, "timestamp": datetime.datetime.now().isoformat()}]
-    }
+        admin_id = user_store.allocate_id(exclude=(user_id,))
 
-    # Write back to file
-    with open(USER_IDS_FILE, 'w') as f:
-        json.dump(user_ids, f, indent=4)
-
-    # Create private channel for the user
-    category = member.guild.get_channel(ALLOWED_CATEGORY_ID)
-    if category:
-        overwrites = {
-            member.guild.default_role: discord.PermissionOverwrite(view_channel=False),
-            member: discord.PermissionOverwrite(view_channel=True, send_messages=True, read_message_history=True),
-            member.guild.get_role(ALLOWED_ROLE_ID[0]): discord.PermissionOverwrite(view_channel=True, send_messages=True, read_message_history=True),
-            member.guild.get_role(SUPER_ADMIN_ROLE_ID): discord.PermissionOverwrite(view_channel=True, send_messages=True, read_message_history=True)
-        }
-        try:
-            await member.guild.create_text_channel(user_id, category=category, overwrites=overwrites)
-            print(f"Created private channel {user_id} for {member}")
-        except Exception as e:
-            print(f"Error creating channel for {member}: {e}")
-
-    # Send welcome message if welcome channel is set
-    try:
-        with open(CONFIG_FILE, 'r') as f:
-            config = json.load(f)
-        welcome_channel_id = config.get('welcome_channel')
-        if welcome_channel_id:
-            welcome_channel = member.guild.get_channel(welcome_channel_id)
-            if welcome_channel:
-                await welcome_channel.send(f"Welcome {member.mention} has joined the server!")
-    except Exception as e:
-        print(f"Error sending welcome message: {e}")
-
-    # Send rules to DM and personal channel
-    rules_message = f"Please send messages only using the command 'MM send [channel]' and only in your personal channel: #{user_id}"
-    try:
-        await member.send(rules_message)
-    except discord.HTTPException:
-        print(f"Could not send DM to {member}")
+    # Save the data with username as key, replacing any stale record
+    user_key = str(member)
+    user_store.delete(user_key)
+    user_store.create(user_key, user_id, role, admin_id)
 
-    # Send rules to personal channel
-    if category:
-        channel = discord.utils.get(category.channels, name=user_id)
-        if channel:
-            try:
-                await channel.send(rules_message)
-            except Exception as e:
-                print(f"Error sending rules to personal channel for {member}: {e}")
+    # Channel setup, the welcome and the rules DM don't depend on each other, so run them together
+    steps = {
+        "sending welcome message": send_welcome(member)
+    }
+    if client.guild_states.config(member.guild).lazy_channels:
+        # The channel is created when the member first runs MM openChannel or an admin targets them
+        rules_message = f"Your anonymous ID is {user_id}. Use 'MM openChannel' to get your personal channel, then send messages there with 'MM send [channel]'."
+    else:
+        rules_message = RULES_MESSAGE.format(user_id=user_id)
+        steps["creating private channel"] = client.channel_provisioner.provision(member, user_key, user_id)
+    steps["sending rules DM"] = send_rules_dm(member, rules_message)
+    results = await asyncio.gather(*steps.values(), return_exceptions=True)
+    for step, result in zip(steps, results):
+        if isinstance(result, Exception):
+            print(f"Error {step} for {member}: {result}")
 
+    client.metrics.observe("member_join", time.monotonic() - started)
     print(f"Generated ID for {member}: user_id={user_id}, role={role}, admin_id={admin_id}")
 
 @client.event
-async def on_member_remove(member):
-    # Load existing user IDs
-    try:
-        with open(USER_IDS_FILE, 'r') as f:
-            user_ids = json.load(f)
-    except FileNotFoundError:
+async def on_raw_member_remove(payload):
+    # Raw, so members that were never cached are handled too
+    member = payload.user
+    guild = client.get_guild(payload.guild_id)
+    if guild is None:
         return
+    client.channel_provisioner.cancel(guild, member.id)
 
+    user_store = client.guild_states.user_store(guild)
     user_key = str(member)
-    if user_key in user_ids:
-        data = user_ids[user_key]
-        user_id = data if isinstance(data, str) else data.get("user_id")
+    data = user_store.get(user_key)
+    if data:
+        user_id = data["user_id"]
 
         # Delete private channel first
-        category = member.guild.get_channel(ALLOWED_CATEGORY_ID)
-        if category and user_id:
-            channel = discord.utils.get(category.channels, name=user_id)
-            if channel:
-                try:
-                    await channel.delete()
-                    print(f"Deleted private channel {user_id} for {member}")
-                except Exception as e:
-                    print(f"Error deleting channel for {member}: {e}")
+        channel = await client.private_channels.fetch(guild, user_key)
+        if channel:
+            try:
+                await client.outbound.run(BACKGROUND, channel.delete(), guild=guild)
+                print(f"Deleted private channel {user_id} for {member}")
+            except Exception as e:
+                print(f"Error deleting channel for {member}: {e}")
+        # An archived channel's export goes with it
+        if client.channel_archiver.discard(guild, user_id):
+            print(f"Deleted archived channel {user_id} for {member}")
 
         # Then delete the user's data
-        del user_ids[user_key]
-        # Write back to file
-        with open(USER_IDS_FILE, 'w') as f:
-            json.dump(user_ids, f, indent=4)
+        user_store.delete(user_key)
         print(f"Deleted data for {member}")
 
+@client.event
+async def on_guild_role_delete(role):
+    client.permissions.invalidate_guild(role.guild.id)
+
+@client.event
+async def on_guild_channel_create(channel):
+    client.private_channels.on_channel_create(channel)
+
+@client.event
+async def on_guild_channel_delete(channel):
+    client.webhook_pool.forget(channel.id)
+    client.private_channels.on_channel_delete(channel)
+    client.spare_pool.on_channel_delete(channel)
+
+@client.event
+async def on_raw_thread_delete(payload):
+    # Raw, so threads that were archived (and so not cached) are handled too
+    guild = client.get_guild(payload.guild_id)
+    if guild:
+        client.private_channels.on_channel_id_delete(guild, payload.thread_id)
+
 @client.event
 async def on_message(message):
     if message.author == client.user:
@@ -232,33 +286,31 @@ async def on_message(message):
     if message.author.bot:
         return
 
-    # Check if the message is in the allowed category or author has allowed role
-    is_allowed = (message.channel.category and message.channel.category.id == ALLOWED_CATEGORY_ID or
-                  (hasattr(message.author, 'roles') and any(role.id in ALLOWED_ROLE_ID for role in message.author.roles)))
+    # DMs belong to no guild, so there is nothing to gate or run
+    if message.guild is None:
+        return
+
+    # Check if the message is in a private channel, the allowed category, or author has allowed role
+    config = client.guild_states.config(message.guild)
+    allowed_category_id = config.allowed_category
+    is_allowed = (client.private_channels.owner(message.channel) is not None or
+                  config.is_allowed_category(getattr(message.channel, "category_id", None)) or
+                  (hasattr(message.author, 'roles') and client.permissions.is_admin(message.author)))
 
-    if is_allowed or ALLOWED_CATEGORY_ID is None:
+    if is_allowed or allowed_category_id is None:
         # Process commands if allowed
         if message.content.startswith(client.command_prefix):
             await client.process_commands(message)
         return
 
     # If not allowed
-    if ALLOWED_CATEGORY_ID is not None:
-        # Delete the message and send DM
-        try:
-            author = message.author
-            await message.delete()
-            print(f"Deleted message from {message.author} in {message.channel}")
-            try:
-                reason = "no message sent without the command :\nMM send [channel] is allowed."
-                reason += " And only inside the allowed channel"
-                await author.send(f"Deleted message : \n \"{message.content}\" \nin : \n{message.channel}.\nReasons : {reason} \nPlease understand.")
-            except discord.HTTPException:
-                pass  # DM failed, probably disabled
-        except discord.Forbidden:
-            print("Bot lacks permission to delete messages.")
-        except discord.NotFound:
-            print("Message not found or already deleted.")
+    if allowed_category_id is not None:
+        # MM openChannel must work from anywhere, since members may not have a private channel yet.
+        # Only the bare command runs, and it is still deleted like any other message here.
+        if message.content.strip() == f"{client.command_prefix}openChannel":
+            await client.process_commands(message)
+        # Queue the message for a batched delete; the author gets one notice per window
+        client.moderation_queue.submit(message)
     else:
         # If no allowed category set, proceed with command if it's a command
         if message.content.startswith(client.command_prefix):
@@ -272,3 +324,6 @@ async def on_command_error(ctx, error):
         await ctx.send(f"An error occurred: {error}")
 
 client.run(os.getenv('DISCORD_TOKEN'))
+
+# Fold every guild's journal into its database before exiting
+client.guild_states.close()
@@ -1,20 +1,21 @@
 import discord
 import os
-import aiohttp
-import io
-import json
 import random
-import string
 import datetime
 from discord.ext import commands
-from config import ALLOWED_CATEGORY_ID, ALLOWED_ROLE_ID, SUPER_ADMIN_ROLE_ID, MEMBER_ROLE_ID, USER_IDS_FILE, CONFIG_FILE, INFOS_FILE
+from outboundScheduler import INTERACTIVE
 
 class MemberCmd(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        self.guild_states = bot.guild_states
+        self.permissions = bot.permissions
+        # The command list only depends on the tier, so each tier's embed is built once
+        self._help_embeds = {tier: self._build_help_embed(tier) for tier in ("superAdmin", "admin", "member", "user")}
 
     @commands.command(name='send')
     async def send(self, ctx, *, args: str = None):
+        config = self.guild_states.config(ctx.guild)
         if not args:
             await ctx.send("Usage: MM send [asAdmin] <channel> <message>")
             return
@@ -38,15 +39,12 @@ class MemberCmd(commands.Cog):
             await ctx.send("Invalid channel.")
             return
 
-        if channel.category and channel.category.id == ALLOWED_CATEGORY_ID:
+        if config.is_allowed_category(channel.category_id) or channel.id == config.thread_hub:
             return
 
         # Get user data
         try:
-            with open(USER_IDS_FILE, 'r') as f:
-                user_ids = json.load(f)
-            user_key = str(ctx.author)
-            user_data = user_ids.get(user_key)
+            user_data = self.guild_states.user_store(ctx.guild).get(str(ctx.author))
             if not user_data:
                 await ctx.send("You don't have an ID. Use MM generateID first.")
                 return
@@ -57,7 +55,7 @@ class MemberCmd(commands.Cog):
 
         # Determine username
         if as_admin:
-            if not any(role.id in ALLOWED_ROLE_ID for role in ctx.author.roles):
+            if not self.permissions.is_admin(ctx.author):
                 await ctx.send("You are not allowed to send as admin.")
                 return
             admin_id = user_data.get("admin_id")
@@ -68,138 +66,93 @@ class MemberCmd(commands.Cog):
         else:
             username = f"user_{user_id}"
 
-        files = []
-        try:
-            for attachment in ctx.message.attachments:
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(attachment.url) as resp:
-                        if resp.status != 200:
-                            return
-                        data = io.BytesIO(await resp.read())
-                        files.append(discord.File(data, filename=attachment.filename))
-        except Exception as e:
-            pass
+        # Download attachments concurrently; report the ones that can't be relayed instead of dropping the message
+        relay = self.bot.attachment_relay
+        files, failures = await relay.fetch_all(ctx.message.attachments)
+        if failures:
+            details = "\n".join(f"- {filename}: {reason}" for filename, reason in failures)
+            await ctx.send(f"Some attachments could not be relayed:\n{details}")
+        if not message and not files:
+            return
 
-        # Create a webhook for the channel
+        # Post through the channel's pooled webhook under the pseudonym
         try:
-            avatar_bytes = await self.bot.user.avatar.read() if self.bot.user.avatar else None
-            webhook = await channel.create_webhook(name=username, avatar=avatar_bytes)
-            avatar_url = self.bot.user.avatar.url if self.bot.user.avatar else None
-            if files:
-                await webhook.send(content=message, files=files, username=username, avatar_url=avatar_url)
-            else:
-                await webhook.send(content=message, username=username, avatar_url=avatar_url)
-            await webhook.delete()
+            await self.bot.outbound.run(INTERACTIVE, self.bot.webhook_pool.send(channel, username, content=message, files=files), guild=ctx.guild)
         except discord.Forbidden:
             try:
                 if files:
-                    await channel.send(content=message, files=files)
+                    # The failed webhook attempt may have read the buffers already
+                    for file in files:
+                        file.reset()
+                    await self.bot.outbound.run(INTERACTIVE, channel.send(content=message, files=files), guild=ctx.guild)
                 else:
-                    await channel.send(content=message)
+                    await self.bot.outbound.run(INTERACTIVE, channel.send(content=message), guild=ctx.guild)
             except discord.Forbidden:
                 pass
             except Exception as e:
                 pass
         except Exception as e:
             pass
+        finally:
+            relay.close_files(files)
 
     @commands.command(name='generateID')
     async def generate_id(self, ctx):
-        # Load existing user IDs
-        try:
-            with open(USER_IDS_FILE, 'r') as f:
-                user_ids = json.load(f)
-        except FileNotFoundError:
-            user_ids = {}
-
+        user_store = self.guild_states.user_store(ctx.guild)
         user_key = str(ctx.author)
 
         # Check current roles
-        has_admin_role = any(role.id in ALLOWED_ROLE_ID for role in ctx.author.roles)
-
-        # Generate unique IDs
-        existing_ids = set()
-        for data in user_ids.values():
-            if isinstance(data, dict):
-                existing_ids.add(data.get("user_id"))
-                if data.get("admin_id"):
-                    existing_ids.add(data.get("admin_id"))
-            elif isinstance(data, str):
-                existing_ids.add(data)
+        has_admin_role = self.permissions.is_admin(ctx.author)
 
         # Check if user already has data
-        if user_key in user_ids:
-            data = user_ids[user_key]
-            updated = False
-            if isinstance(data, str):
-                # Old format: migrate to new
-                old_user_id = data
-                role = "admin" if has_admin_role else "user"
-                admin_id = None
-                if role == "admin":
-                    admin_id = ''.join(random.choices(string.ascii_letters + string.digits, k=12))
-                    while admin_id in existing_ids or admin_id == old_user_id:
-                        admin_id = ''.join(random.choices(string.ascii_letters + string.digits, k=12))
-                user_ids[user_key] = {
-                    "user_id": old_user_id,
-                    "role": role,
-                    "admin_id": admin_id,
-                    "role_history": [{"role": role, "timestamp": datetime.datetime.now().isoformat()}]
-                }
-                updated = True
-                response = f"Your user ID is: {old_user_id}\nRole: {role}"
-                if admin_id:
-                    response += f"\nAdmin ID: {admin_id}"
-            else:
-                # New format: check if role needs update
-                user_id = data["user_id"]
-                role = data["role"]
-                admin_id = data.get("admin_id")
-                role_history = data.get("role_history", [])
-                if has_admin_role and role != "admin":
-                    role = "admin"
-                    if not admin_id:
-                        admin_id = ''.join(random.choices(string.ascii_letters + string.digits, k=12))
-                        while admin_id in existing_ids or admin_id == user_id:
-                            admin_id = ''.join(random.choices(string.ascii_letters + string.digits, k=12))
-                    data["role"] = role
-                    data["admin_id"] = admin_id
-                    role_history.append({"role": role, "timestamp": datetime.datetime.now().isoformat()})
-                    data["role_history"] = role_history
-                    updated = True
-                response = f"Your user ID is: {user_id}\nRole: {role}"
-                if admin_id:
-                    response += f"\nAdmin ID: {admin_id}"
-            if updated:
-                # Write back to file
-                with open(USER_IDS_FILE, 'w') as f:
-                    json.dump(user_ids, f, indent=4)
+        data = user_store.get(user_key)
+        if data:
+            # Check if role needs update
+            user_id = data["user_id"]
+            role = data["role"]
+            admin_id = data.get("admin_id")
+            if has_admin_role and role != "admin":
+                role = "admin"
+                if not admin_id:
+                    admin_id = user_store.allocate_id()
+                user_store.set_role(user_key, role, admin_id=admin_id)
         else:
             # Generate new data
-            user_id = ''.join(random.choices(string.ascii_letters + string.digits, k=12))
-            while user_id in existing_ids:
-                user_id = ''.join(random.choices(string.ascii_letters + string.digits, k=12))
+            user_id = user_store.allocate_id()
             role = "admin" if has_admin_role else "user"
             admin_id = None
             if role == "admin":
-                admin_id = ''.join(random.choices(string.ascii_letters + string.digits, k=12))
-                while admin_id in existing_ids or admin_id == user_id:
-                    admin_id = ''.join(random.choices(string.ascii_letters + string.digits, k=12))
-            user_ids[user_key] = {
-                "user_id": user_id,
-                "role": role,
-                "admin_id": admin_id,
-                "role_history": [{"role": role, "timestamp": datetime.datetime.now().isoformat()}]
-            }
-            # Write back to file
-            with open(USER_IDS_FILE, 'w') as f:
-                json.dump(user_ids, f, indent=4)
-            response = f"Your user ID is: {user_id}\nRole: {role}"
-            if admin_id:
-                response += f"\nAdmin ID: {admin_id}"
+                admin_id = user_store.allocate_id(exclude=(user_id,))
+            user_store.create(user_key, user_id, role, admin_id)
+
+        response = f"Your user ID is: {user_id}\nRole: {role}"
+        if admin_id:
+            response += f"\nAdmin ID: {admin_id}"
 
         await ctx.send(response)
 
+    @commands.command(name='openChannel')
+    async def open_channel(self, ctx):
+        config = self.guild_states.config(ctx.guild)
+        user_key = str(ctx.author)
+        if not self.guild_states.user_store(ctx.guild).get(user_key):
+            await ctx.send("You don't have an ID. Use MM generateID first.")
+            return
+        if not config.allowed_category and not config.thread_mode:
+            await ctx.send("No allowed category is set, so private channels can't be created.")
+            return
+
+        # Creates the channel on first use; afterwards it just points to it
+        try:
+            channel = await self.bot.private_channels.ensure(ctx.author, lane=INTERACTIVE)
+        except discord.HTTPException as e:
+            await ctx.send(f"Could not create your private channel: {e}")
+            return
+        if not channel:
+            await ctx.send("Could not create your private channel.")
+            return
+        await ctx.send(f"Your private channel is {channel.mention}.")
+
     @commands.command(name='adminRequest')
     async def admin_request(self, ctx, *, content: str = None):
         if not content:
@@ -207,23 +160,17 @@ class MemberCmd(commands.Cog):
             return
 
         # Check if user has member role or higher
-        has_member_role = any(role.id == MEMBER_ROLE_ID for role in ctx.author.roles)
-        has_admin_role = any(role.id in ALLOWED_ROLE_ID for role in ctx.author.roles)
+        has_member_role = self.permissions.is_member(ctx.author)
+        has_admin_role = self.permissions.is_admin(ctx.author)
         if not (has_member_role or has_admin_role):
             await ctx.send("You must have member role or higher to use this command.")
             return
 
         # Load user data
-        try:
-            with open(USER_IDS_FILE, 'r') as f:
-                user_ids = json.load(f)
-        except FileNotFoundError:
-            await ctx.send("No user data found.")
-            return
-
+        user_store = self.guild_states.user_store(ctx.guild)
         user_key = str(ctx.author)
-        user_data = user_ids.get(user_key)
-        if not user_data or isinstance(user_data, str):
+        user_data = user_store.get(user_key)
+        if not user_data:
             await ctx.send("You don't have valid user data. Use MM generateID first.")
             return
 
@@ -241,14 +188,14 @@ class MemberCmd(commands.Cog):
                 pass  # Invalid timestamp, proceed
 
         # Get list of admins
-        admins = [uk for uk, d in user_ids.items() if isinstance(d, dict) and d.get("role") == "admin"]
+        admins = user_store.admin_keys()
         if not admins:
             await ctx.send("No admins available to handle requests.")
             return
 
         # Select random admin
         random_admin_key = random.choice(admins)
-        admin_data = user_ids[random_admin_key]
+        admin_data = user_store.get(random_admin_key)
         admin_user_id = admin_data["user_id"]
         admin_id = admin_data.get("admin_id")
 
@@ -260,52 +207,51 @@ class MemberCmd(commands.Cog):
             username = f"user_{requester_user_id}"
 
         # Get admin member
-        admin_member = ctx.guild.get_member_named(random_admin_key)
+        admin_member = await self.bot.member_lookup.get_named(ctx.guild, random_admin_key)
         if not admin_member:
             await ctx.send("Selected admin not found in guild.")
             return
 
         # Send DM to admin
         message = f"Admin request by {username} :\n\n{content}"
-        try:
-            await admin_member.send(f"```{message}```")
+        if await self.bot.direct_messages.send(admin_member, f"```{message}```", lane=INTERACTIVE):
             await ctx.send(f"Your request have successfully sent to admin_{admin_id}")
-        except discord.HTTPException:
+        else:
             await ctx.send("Failed to send DM to the admin.")
 
         # Update last request timestamp
-        user_data["last_admin_request"] = datetime.datetime.now().isoformat()
-        with open(USER_IDS_FILE, 'w') as f:
-            json.dump(user_ids, f, indent=4)
+        user_store.update(user_key, last_admin_request=datetime.datetime.now().isoformat())
 
     @commands.command(name='helpDisplay')
     async def help_command(self, ctx):
-        # Reload infos to ensure up to date
-        try:
-            with open(INFOS_FILE, 'r') as f:
-                infos = json.load(f)
-            global ALLOWED_CATEGORY_ID, ALLOWED_ROLE_ID, SUPER_ADMIN_ROLE_ID, MEMBER_ROLE_ID
-            ALLOWED_CATEGORY_ID = infos.get("allowed_category")
-            ALLOWED_ROLE_ID = infos.get("admin_roles", [])
-            SUPER_ADMIN_ROLE_ID = infos.get("super_admin_role")
-            MEMBER_ROLE_ID = infos.get("member_roles", [])
-        except Exception as e:
-            print(f"Error reloading infos: {e}")
-
         # Determine user role
-        is_owner = ctx.author == ctx.guild.owner
-        is_super_admin = is_owner or (SUPER_ADMIN_ROLE_ID and any(role.id == SUPER_ADMIN_ROLE_ID for role in ctx.author.roles))
-        is_admin = is_owner or any(role.id in ALLOWED_ROLE_ID for role in ctx.author.roles)
-        is_member = is_owner or any(role.id in MEMBER_ROLE_ID for role in ctx.author.roles)
+        is_owner = ctx.author.id == ctx.guild.owner_id
+        is_super_admin = is_owner or self.permissions.is_super_admin(ctx.author)
+        is_admin = is_owner or self.permissions.is_admin(ctx.author)
+        is_member = is_owner or self.permissions.is_member(ctx.author)
 
         print("is member:", is_member, "is admin:", is_admin, "is super admin:", is_super_admin, "for author:", ctx.author.name)
 
+        if is_super_admin:
+            tier = "superAdmin"
+        elif is_admin:
+            tier = "admin"
+        elif is_member:
+            tier = "member"
+        else:
+            tier = "user"
+
+        await ctx.send(embed=self._help_embeds[tier])
+
+    def _build_help_embed(self, tier):
         embed = discord.Embed(title="MaskerBot Commands", color=0x00ff00)
 
-        if is_super_admin:
+        if tier == "superAdmin":
             embed.add_field(name="MM send [asAdmin] <channel> <message>", value="Send a message to a channel anonymously. Use 'asAdmin' to send as admin.", inline=False)
             embed.add_field(name="MM generateID", value="Generate or retrieve your user ID and role.", inline=False)
-            embed.add_field(name="MM purgeChannel [amount] [channel]", value="Purge messages from a channel. Specify amount and/or channel.", inline=False)
+            embed.add_field(name="MM openChannel", value="Open your private channel, creating it if needed.", inline=False)
+            embed.add_field(name="MM purgeChannel [amount] [channel] [filters]", value="Purge messages from a channel. Specify amount and/or channel. Filters: user:<@user>, persona:user_xxx, regex:<pattern>, has:attachments, before:<date>, after:<date>.", inline=False)
+            embed.add_field(name="MM cancelPurge [channel]", value="Stop a purge that is still running.", inline=False)
             embed.add_field(name="MM makeChannel <category> <channel> [voc] [adminOnly]", value="Create a private channel in a category. Use 'voc' to create a voice channel. Use 'adminOnly' to restrict to admins only.", inline=False)
             embed.add_field(name="MM removeChannel <category> <channel>", value="Remove a channel from a category.", inline=False)
             embed.add_field(name="MM makeCategory <category> [adminOnly]", value="Create a category. Use 'adminOnly' to restrict to admins only.", inline=False)
@@ -325,11 +271,18 @@ class MemberCmd(commands.Cog):
             embed.add_field(name="MM addRole <type> <roles>", value="Add roles to admin or member.", inline=False)
             embed.add_field(name="MM removeFromRole <type> <roles>", value="Remove roles from admin or member.", inline=False)
             embed.add_field(name="MM setAllowedCategory", value="Set the category of this channel as the allowed category.", inline=False)
+            embed.add_field(name="MM setSparePool <size> [refill_seconds]", value="Keep spare private channels ready so joins get a channel instantly.", inline=False)
+            embed.add_field(name="MM setArchiving <idle_days> [max_live_channels]", value="Export and delete idle private channels; they are restored on next use.", inline=False)
+            embed.add_field(name="MM setLazyChannels <on|off>", value="Create private channels on first use instead of on join.", inline=False)
+            embed.add_field(name="MM setPrivateSpaces <channels|threads>", value="Give each user a private channel, or a private thread in this channel.", inline=False)
+            embed.add_field(name="MM showMetrics", value="Show the bot's internal counters and latencies.", inline=False)
             embed.add_field(name="MM helpDisplay", value="Display this help message.", inline=False)
-        elif is_admin:
+        elif tier == "admin":
             embed.add_field(name="MM send [asAdmin] <channel> <message>", value="Send a message to a channel anonymously. Use 'asAdmin' to send as admin.", inline=False)
             embed.add_field(name="MM generateID", value="Generate or retrieve your user ID and role.", inline=False)
-            embed.add_field(name="MM purgeChannel [amount] [channel]", value="Purge messages from a channel. Specify amount and/or channel.", inline=False)
+            embed.add_field(name="MM openChannel", value="Open your private channel, creating it if needed.", inline=False)
+            embed.add_field(name="MM purgeChannel [amount] [channel] [filters]", value="Purge messages from a channel. Specify amount and/or channel. Filters: user:<@user>, persona:user_xxx, regex:<pattern>, has:attachments, before:<date>, after:<date>.", inline=False)
+            embed.add_field(name="MM cancelPurge [channel]", value="Stop a purge that is still running.", inline=False)
             embed.add_field(name="MM makeChannel <category> <channel> [voc]", value="Create a private channel in a category. Use 'voc' to create a voice channel.", inline=False)
             embed.add_field(name="MM removeChannel <category> <channel>", value="Remove a channel from a category.", inline=False)
             embed.add_field(name="MM makeUser <user>", value="Grant member role to a user.", inline=False)
@@ -343,11 +296,12 @@ class MemberCmd(commands.Cog):
         else:
             embed.add_field(name="MM send <channel> <message>", value="Send a message to a channel anonymously.", inline=False)
             embed.add_field(name="MM generateID", value="Generate or retrieve your user ID and role.", inline=False)
-            if is_member:
+            embed.add_field(name="MM openChannel", value="Open your private channel, creating it if needed.", inline=False)
+            if tier == "member":
                 embed.add_field(name="MM adminRequest <content>", value="Send an admin request to a random admin. Limited to one per week.", inline=False)
             embed.add_field(name="MM helpDisplay", value="Display this help message.", inline=False)
 
-        await ctx.send(embed=embed)
+        return embed
 
 async def setup(bot):
     await bot.add_cog(MemberCmd(bot))
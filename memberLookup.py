@@ -0,0 +1,30 @@
+import asyncio
+import discord
+
+# Members returned by one gateway name query; matches are then narrowed to the exact name
+QUERY_LIMIT = 100
+
+
+class MemberLookup:
+    # Members by name: from the member cache when it has them, otherwise from a gateway query.
+    # With a trimmed member cache (see clientOptions) most members are not cached.
+    def __init__(self, bot):
+        self.bot = bot
+        self.metrics = bot.metrics
+
+    async def get_named(self, guild, name):
+        # name as stored for user keys: str(member), "name" or the older "name#1234"
+        member = guild.get_member_named(name)
+        if member is not None:
+            self.metrics.incr("member_lookup.cached")
+            return member
+        self.metrics.incr("member_lookup.queried")
+        username, _, discriminator = name.rpartition('#')
+        if not (username and discriminator.isdigit() and len(discriminator) == 4):
+            username = name
+        try:
+            members = await guild.query_members(query=username, limit=QUERY_LIMIT)
+        except (asyncio.TimeoutError, discord.ClientException) as e:
+            print(f"Member query for {name} in {guild} failed: {e}")
+            return None
+        return discord.utils.find(lambda member: str(member) == name, members)
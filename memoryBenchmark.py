@@ -0,0 +1,114 @@
+import argparse
+import gc
+import tracemalloc
+import discord
+
+from clientOptions import client_options
+
+# Offline benchmark of the memory the member cache takes under each intent and cache setting.
+# It feeds discord.py the guild payloads Discord would send, without connecting:
+#   python memoryBenchmark.py --members 50000 --guilds 2
+
+BASE_ID = 10 ** 17
+ROLE_COUNT = 20
+# Share of members online; presences only arrive for these
+ONLINE_RATIO = 0.2
+CHUNK_SIZE = 1000
+
+# (label, intent profile, member cache, chunk at startup); the first row is the old setup
+SCENARIOS = (
+    ("before: all intents, full cache", "all", "all", True),
+    ("default intents, full cache", "default", "all", True),
+    ("minimal intents, joined cache", "minimal", "joined", False),
+    ("minimal intents, no cache", "minimal", "none", False),
+)
+
+
+def role_payload(role_id, position):
+    return {"id": str(role_id), "name": f"role{position}", "permissions": "0", "position": position,
+            "color": 0, "hoist": False, "managed": False, "mentionable": False}
+
+
+def member_payload(user_id, index):
+    return {
+        "user": {"id": str(user_id), "username": f"user{index}", "discriminator": "0", "global_name": f"User {index}", "avatar": None},
+        "roles": [str(BASE_ID + 1 + index % ROLE_COUNT)],
+        "joined_at": "2024-01-01T00:00:00+00:00",
+        "nick": None, "deaf": False, "mute": False, "flags": 0,
+    }
+
+
+def presence_payload(user_id, guild_id):
+    return {"user": {"id": str(user_id)}, "guild_id": str(guild_id), "status": "online",
+            "activities": [{"name": "Some Game", "type": 0}], "client_status": {"desktop": "online"}}
+
+
+def guild_payloads(guild_index, members, intents):
+    # GUILD_CREATE for a large guild carries only online members, and only with presences;
+    # the rest arrive in member chunks if the client asks for them
+    guild_id = BASE_ID * 2 + guild_index
+    user_ids = [BASE_ID * 3 + guild_index * members + index for index in range(members)]
+    online = list(enumerate(user_ids[:int(members * ONLINE_RATIO)])) if intents.presences else []
+    guild = {
+        "id": str(guild_id), "name": f"guild{guild_index}", "owner_id": str(user_ids[0]), "member_count": members,
+        "large": True, "features": [], "emojis": [], "stickers": [], "channels": [], "threads": [],
+        "roles": [role_payload(guild_id, 0)] + [role_payload(BASE_ID + 1 + i, i + 1) for i in range(ROLE_COUNT)],
+        "members": [member_payload(user_id, index) for index, user_id in online],
+        "presences": [presence_payload(user_id, guild_id) for _, user_id in online],
+    }
+    chunks = []
+    for start in range(0, members, CHUNK_SIZE):
+        ids = user_ids[start:start + CHUNK_SIZE]
+        chunks.append({
+            "members": [member_payload(user_id, start + offset) for offset, user_id in enumerate(ids)],
+            "presences": [presence_payload(user_id, guild_id) for user_id in ids[:int(len(ids) * ONLINE_RATIO)]] if intents.presences else [],
+        })
+    return guild, chunks
+
+
+def measure(profile, cache_policy, chunk, guilds, members):
+    options = client_options(profile, cache_policy, chunk)
+    client = discord.Client(**options)
+    state = client._connection
+    payloads = [guild_payloads(index, members, options["intents"]) for index in range(guilds)]
+    gc.collect()
+    tracemalloc.start()
+    for guild_data, chunks in payloads:
+        guild = state._add_guild_from_data(guild_data)
+        if not options["chunk_guilds_at_startup"]:
+            continue
+        # What a startup chunk request does with each chunk
+        for chunk_data in chunks:
+            chunk_members = [discord.Member(guild=guild, data=data, state=state) for data in chunk_data["members"]]
+            by_id = {member.id: member for member in chunk_members}
+            for presence in chunk_data["presences"]:
+                member = by_id.get(int(presence["user"]["id"]))
+                if member is not None:
+                    member._presence_update(discord.RawPresenceUpdateEvent(data=presence, state=state), presence["user"])
+            for member in chunk_members:
+                guild._add_member(member)
+    # Drop the payloads so only what the cache kept is counted
+    del payloads, guild_data, chunks
+    gc.collect()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    cached = sum(len(guild.members) for guild in state.guilds)
+    return current, cached
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Member cache memory per intent and cache setting")
+    parser.add_argument("--members", type=int, default=50000, help="members per guild")
+    parser.add_argument("--guilds", type=int, default=1)
+    args = parser.parse_args()
+
+    print(f"{args.guilds} guild(s) x {args.members} members, {ONLINE_RATIO:.0%} online")
+    baseline = None
+    for label, profile, cache_policy, chunk in SCENARIOS:
+        used, cached = measure(profile, cache_policy, chunk, args.guilds, args.members)
+        baseline = baseline or used
+        print(f"{label:<34} {used / 2 ** 20:8.2f} MiB  {cached:>8} members cached  ({used / baseline:.0%} of before)")
+
+
+if __name__ == "__main__":
+    main()
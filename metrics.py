@@ -0,0 +1,40 @@
+from collections import deque
+
+# Latency samples kept per timer; percentiles are over this recent window
+TIMER_WINDOW = 1000
+
+
+class Metrics:
+    def __init__(self, timer_window=TIMER_WINDOW):
+        # name -> count
+        self.counters = {}
+        # name -> recent durations in seconds
+        self.timers = {}
+        self.timer_window = timer_window
+
+    def incr(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def get(self, name):
+        return self.counters.get(name, 0)
+
+    def observe(self, name, seconds):
+        samples = self.timers.get(name)
+        if samples is None:
+            samples = self.timers[name] = deque(maxlen=self.timer_window)
+        samples.append(seconds)
+        self.incr(f"{name}.count")
+
+    def percentile(self, name, percent):
+        samples = sorted(self.timers.get(name, ()))
+        if not samples:
+            return None
+        index = min(len(samples) - 1, int(len(samples) * percent / 100))
+        return samples[index]
+
+    def snapshot(self):
+        values = dict(self.counters)
+        for name in self.timers:
+            values[f"{name}.p50_ms"] = round(self.percentile(name, 50) * 1000)
+            values[f"{name}.p95_ms"] = round(self.percentile(name, 95) * 1000)
+        return dict(sorted(values.items()))
@@ -0,0 +1,97 @@
+import asyncio
+import discord
+from outboundScheduler import MODERATION
+
+# How long a channel collects violations before they are deleted in one call
+FLUSH_DELAY = 1.0
+BULK_DELETE_SIZE = 100
+# Deletions for one author within this window are reported in a single DM
+NOTICE_WINDOW = 10.0
+# Deleted messages quoted in a notice; the rest are counted
+NOTICE_MAX_QUOTES = 5
+NOTICE_QUOTE_LENGTH = 200
+
+REASON = "no message sent without the command :\nMM send [channel] is allowed. And only inside the allowed channel"
+
+
+class ModerationQueue:
+    def __init__(self, bot, flush_delay=FLUSH_DELAY, notice_window=NOTICE_WINDOW):
+        self.bot = bot
+        self.flush_delay = flush_delay
+        self.notice_window = notice_window
+        # channel_id -> messages waiting to be deleted
+        self._pending = {}
+        self._flushers = {}
+        # author_id -> (author, [(channel, content)]) waiting to be reported
+        self._notices = {}
+        self._notifiers = {}
+
+    def submit(self, message):
+        # Called from on_message; never awaits, so the gate returns immediately
+        channel_id = message.channel.id
+        self._pending.setdefault(channel_id, []).append(message)
+        if channel_id not in self._flushers:
+            self._flushers[channel_id] = asyncio.create_task(self._flush_later(message.channel))
+
+    async def _flush_later(self, channel):
+        try:
+            await asyncio.sleep(self.flush_delay)
+            # Keep draining: violations arriving during a delete call join the next batch
+            while self._pending.get(channel.id):
+                batch = self._pending[channel.id][:BULK_DELETE_SIZE]
+                del self._pending[channel.id][:BULK_DELETE_SIZE]
+                await self._delete(channel, batch)
+        finally:
+            self._pending.pop(channel.id, None)
+            del self._flushers[channel.id]
+
+    async def _delete(self, channel, batch):
+        try:
+            if len(batch) == 1:
+                await self.bot.outbound.run(MODERATION, batch[0].delete(), guild=channel.guild)
+            else:
+                await self.bot.outbound.run(MODERATION, channel.delete_messages(batch), guild=channel.guild)
+        except discord.Forbidden:
+            print("Bot lacks permission to delete messages.")
+            return
+        except discord.NotFound:
+            print("Message not found or already deleted.")
+            return
+        except discord.HTTPException as e:
+            print(f"Deleting {len(batch)} messages in {channel} failed: {e}")
+            return
+        print(f"Deleted {len(batch)} messages in {channel}")
+        for message in batch:
+            self._notify(message)
+
+    def _notify(self, message):
+        author = message.author
+        if self.bot.direct_messages.is_closed(author):
+            # The notice would be skipped anyway, so don't collect it
+            self.bot.metrics.incr("dm_closed_cache.hit")
+            return
+        _, deleted = self._notices.setdefault(author.id, (author, []))
+        deleted.append((message.channel, message.content))
+        if author.id not in self._notifiers:
+            self._notifiers[author.id] = asyncio.create_task(self._notify_later(author.id))
+
+    async def _notify_later(self, author_id):
+        try:
+            await asyncio.sleep(self.notice_window)
+            author, deleted = self._notices.pop(author_id)
+            await self.bot.direct_messages.send(author, self._notice(deleted), lane=MODERATION)
+        finally:
+            self._notices.pop(author_id, None)
+            del self._notifiers[author_id]
+
+    def _notice(self, deleted):
+        if len(deleted) == 1:
+            channel, content = deleted[0]
+            return f"Deleted message : \n \"{content[:NOTICE_QUOTE_LENGTH]}\" \nin : \n{channel}.\nReasons : {REASON} \nPlease understand."
+        lines = [f"Deleted {len(deleted)} messages :"]
+        for channel, content in deleted[:NOTICE_MAX_QUOTES]:
+            lines.append(f" \"{content[:NOTICE_QUOTE_LENGTH]}\" in {channel}")
+        if len(deleted) > NOTICE_MAX_QUOTES:
+            lines.append(f" ...and {len(deleted) - NOTICE_MAX_QUOTES} more")
+        lines.append(f"Reasons : {REASON} \nPlease understand.")
+        return "\n".join(lines)
@@ -0,0 +1,120 @@
+import asyncio
+from collections import deque
+
+# Lanes in priority order: when a slot frees up, the first lane with a waiter gets it
+INTERACTIVE = "interactive"
+MODERATION = "moderation"
+BACKGROUND = "background"
+# Purge deletes: long runs that may sleep through rate limits while holding their slots
+PURGE = "purge"
+LANES = (INTERACTIVE, MODERATION, BACKGROUND, PURGE)
+
+# Calls in flight to Discord at once, per guild. Discord's rate limits are per guild and
+# channel, and discord.py waits out 429s inside the call, so each guild gets its own slots
+# and a slow guild can't hold up the others. Calls without a guild (DMs) share one budget.
+MAX_IN_FLIGHT = 8
+# Per-lane caps; moderation, background and purge together stay below MAX_IN_FLIGHT,
+# so a command reply never waits behind a join wave or a purge, and each of those
+# lanes keeps its own slots however long the others are stuck
+LANE_LIMITS = {
+    INTERACTIVE: 8,
+    MODERATION: 3,
+    BACKGROUND: 2,
+    PURGE: 2,
+}
+
+
+class _Budget:
+    # One guild's slots and waiters
+    def __init__(self):
+        self.in_flight = 0
+        self.lane_in_flight = {lane: 0 for lane in LANES}
+        # lane -> futures of calls waiting for a slot, oldest first
+        self.waiting = {lane: deque() for lane in LANES}
+
+    def idle(self):
+        return not self.in_flight and not any(self.waiting.values())
+
+
+class OutboundScheduler:
+    def __init__(self, metrics, max_in_flight=MAX_IN_FLIGHT, lane_limits=LANE_LIMITS):
+        self.metrics = metrics
+        self.max_in_flight = max_in_flight
+        self.lane_limits = dict(lane_limits)
+        # guild_id (None for calls outside a guild) -> _Budget, dropped when idle
+        self._budgets = {}
+
+    async def run(self, lane, coro, guild=None):
+        # Awaits coro once the lane gets a slot in the guild's budget and returns its result
+        key = getattr(guild, 'id', guild)
+        budget = self._budgets.get(key)
+        if budget is None:
+            budget = self._budgets[key] = _Budget()
+        try:
+            await self._acquire(budget, lane)
+        except BaseException:
+            coro.close()
+            self._drop_if_idle(key, budget)
+            raise
+        try:
+            return await coro
+        finally:
+            self._release(budget, lane)
+            self._drop_if_idle(key, budget)
+
+    def _drop_if_idle(self, key, budget):
+        if budget.idle() and self._budgets.get(key) is budget:
+            del self._budgets[key]
+
+    def _has_slot(self, budget, lane):
+        return budget.in_flight < self.max_in_flight and budget.lane_in_flight[lane] < self.lane_limits[lane]
+
+    def _ahead(self, budget, lane):
+        # Waiters that should be served before a new call in this lane
+        for other in LANES:
+            if budget.waiting[other]:
+                return True
+            if other == lane:
+                return False
+        return False
+
+    async def _acquire(self, budget, lane):
+        if self._has_slot(budget, lane) and not self._ahead(budget, lane):
+            self._take(budget, lane)
+            return
+        self.metrics.incr(f"outbound.{lane}.queued")
+        waiter = asyncio.get_running_loop().create_future()
+        budget.waiting[lane].append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Granted a slot just as we were cancelled: hand it back
+                self._release(budget, lane)
+            elif waiter in budget.waiting[lane]:
+                # Otherwise _wake may already have dropped it
+                budget.waiting[lane].remove(waiter)
+            raise
+
+    def _take(self, budget, lane):
+        budget.in_flight += 1
+        budget.lane_in_flight[lane] += 1
+        self.metrics.incr(f"outbound.{lane}.sent")
+
+    def _release(self, budget, lane):
+        budget.in_flight -= 1
+        budget.lane_in_flight[lane] -= 1
+        self._wake(budget)
+
+    def _wake(self, budget):
+        for lane in LANES:
+            waiting = budget.waiting[lane]
+            while waiting and self._has_slot(budget, lane):
+                waiter = waiting.popleft()
+                if waiter.done():
+                    # Cancelled while queued; its task hasn't resumed to remove it yet
+                    continue
+                self._take(budget, lane)
+                waiter.set_result(None)
+            if waiting and budget.in_flight >= self.max_in_flight:
+                return
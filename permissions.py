@@ -0,0 +1,74 @@
+NONE = "none"
+MEMBER = "member"
+ADMIN = "admin"
+SUPER_ADMIN = "superAdmin"
+
+
+class PermissionResolver:
+    def __init__(self, guild_states):
+        self.guild_states = guild_states
+        # guild_id -> (member_roles, admin_roles, super_admin_roles) as frozensets
+        self._roles = {}
+        # (guild_id, role IDs) -> (is_member, is_admin, is_super_admin). Keyed by the roles
+        # rather than the member: members that aren't cached never get on_member_update, and
+        # every message carries the author's current roles anyway
+        self._flags = {}
+        guild_states.subscribe(self._rebuild)
+
+    def _rebuild(self, config):
+        # Role sets are rebuilt once per config change; that guild's cached flags are now stale
+        self._roles.pop(config.guild_id, None)
+        self.invalidate_guild(config.guild_id)
+
+    def _role_sets(self, guild):
+        roles = self._roles.get(guild.id)
+        if roles is None:
+            config = self.guild_states.config(guild)
+            roles = self._roles[guild.id] = (
+                frozenset(config.member_roles),
+                frozenset(config.admin_roles),
+                frozenset([config.super_admin_role]) if config.super_admin_role else frozenset()
+            )
+        return roles
+
+    def _member_flags(self, member):
+        guild = getattr(member, 'guild', None)
+        if guild is None:
+            # Users outside a guild (e.g. in DMs) have no roles
+            return (False, False, False)
+        # member._roles holds the raw role IDs; member.roles would build and sort Role objects
+        key = (guild.id, tuple(getattr(member, '_roles', ())))
+        flags = self._flags.get(key)
+        if flags is None:
+            member_roles, admin_roles, super_admin_roles = self._role_sets(guild)
+            role_ids = set(key[1])
+            flags = (
+                not member_roles.isdisjoint(role_ids),
+                not admin_roles.isdisjoint(role_ids),
+                not super_admin_roles.isdisjoint(role_ids)
+            )
+            self._flags[key] = flags
+        return flags
+
+    def is_member(self, member):
+        return self._member_flags(member)[0]
+
+    def is_admin(self, member):
+        return self._member_flags(member)[1]
+
+    def is_super_admin(self, member):
+        return self._member_flags(member)[2]
+
+    def tier(self, member):
+        is_member, is_admin, is_super_admin = self._member_flags(member)
+        if is_super_admin:
+            return SUPER_ADMIN
+        if is_admin:
+            return ADMIN
+        if is_member:
+            return MEMBER
+        return NONE
+
+    def invalidate_guild(self, guild_id):
+        for key in [key for key in self._flags if key[0] == guild_id]:
+            del self._flags[key]
@@ -0,0 +1,198 @@
+import asyncio
+import discord
+from outboundScheduler import BACKGROUND
+
+# Discord's limit on channels in one category
+CATEGORY_CHANNEL_LIMIT = 50
+# Private threads archive after a week without messages; posting in them reopens them
+THREAD_ARCHIVE_MINUTES = 10080
+
+RULES_MESSAGE = "Please send messages only using the command 'MM send [channel]' and only in your personal channel: #{user_id}"
+
+
+class PrivateChannels:
+    def __init__(self, bot):
+        self.bot = bot
+        self.guild_states = bot.guild_states
+        # Staff overwrites per guild, rebuilt once per config change
+        self._overwrites = {}
+        # (guild_id, user_key) -> lock, so two triggers never create the same channel twice
+        self._locks = {}
+        # guild_id -> lock held while picking a category and creating a channel in it
+        self._category_locks = {}
+        # category_id -> IDs of channels we created that the guild cache may not show yet
+        self._recent = {}
+        self.guild_states.subscribe(self._reset_overwrites)
+
+    def _reset_overwrites(self, config):
+        self._overwrites.pop(config.guild_id, None)
+
+    def overwrites(self, guild):
+        overwrites = self._overwrites.get(guild.id)
+        if overwrites is None:
+            config = self.guild_states.config(guild)
+            overwrites = self._overwrites[guild.id] = {
+                guild.default_role: discord.PermissionOverwrite(view_channel=False),
+                guild.get_role(config.admin_roles[0]): discord.PermissionOverwrite(view_channel=True, send_messages=True, read_message_history=True),
+                guild.get_role(config.super_admin_role): discord.PermissionOverwrite(view_channel=True, send_messages=True, read_message_history=True)
+            }
+        return dict(overwrites)
+
+    def get(self, guild, user_key):
+        # The user's private channel or thread, looked up by its recorded ID so renames don't break it.
+        # Archived threads are not cached; use fetch when they matter.
+        record = self.guild_states.user_store(guild).get(user_key)
+        if not record or not record.get("channel_id"):
+            return None
+        return guild.get_channel_or_thread(record["channel_id"])
+
+    async def fetch(self, guild, user_key):
+        # Like get, but asks Discord for spaces missing from the cache, such as archived threads
+        channel = self.get(guild, user_key)
+        if channel:
+            return channel
+        user_store = self.guild_states.user_store(guild)
+        record = user_store.get(user_key)
+        if not record or not record.get("channel_id"):
+            return None
+        try:
+            return await guild.fetch_channel(record["channel_id"])
+        except discord.NotFound:
+            user_store.update(user_key, channel_id=None)
+            return None
+
+    def owner(self, channel):
+        # Reverse lookup: the user key owning this private channel, or None. Runs on every
+        # message, so it reads the index rather than copying the owner's record.
+        return self.guild_states.user_store(channel.guild).by_channel_id.get(channel.id)
+
+    def record(self, user_key, channel):
+        self.guild_states.user_store(channel.guild).update(user_key, channel_id=channel.id)
+
+    async def create(self, member, user_key, user_id, lane=BACKGROUND):
+        # Create and record the member's private channel (or thread), then post the rules into it
+        if self.guild_states.config(member.guild).thread_mode:
+            return await self._create_thread(member, user_key, user_id, lane)
+        guild = member.guild
+        overwrites = self.overwrites(guild)
+        overwrites[member] = discord.PermissionOverwrite(view_channel=True, send_messages=True, read_message_history=True)
+        spare = self.bot.spare_pool.claim(guild)
+        if spare:
+            # A pre-created spare only needs renaming and opening up to the member: one edit
+            channel = await self.bot.outbound.run(lane, spare.edit(name=user_id, overwrites=overwrites), guild=guild)
+            print(f"Claimed spare channel for {member} as {user_id}")
+        else:
+            channel = await self.create_in_group(guild, user_id, overwrites, lane)
+            if not channel:
+                return None
+            print(f"Created private channel {user_id} for {member}")
+        self.record(user_key, channel)
+        await self.bot.outbound.run(lane, channel.send(RULES_MESSAGE.format(user_id=user_id)), guild=guild)
+        # A channel that was archived for inactivity comes back with its history
+        await self.bot.channel_archiver.restore(channel, user_id, lane)
+        return channel
+
+    async def create_in_group(self, guild, name, overwrites, lane=BACKGROUND):
+        # Create a text channel in the first allowed category with room
+        async with self._category_locks.setdefault(guild.id, asyncio.Lock()):
+            category = await self._category_with_room(guild, lane)
+            if not category:
+                return None
+            channel = await self.bot.outbound.run(lane, guild.create_text_channel(name, category=category, overwrites=overwrites), guild=guild)
+            self._recent.setdefault(category.id, set()).add(channel.id)
+        return channel
+
+    async def _create_thread(self, member, user_key, user_id, lane):
+        hub = member.guild.get_channel(self.guild_states.config(member.guild).thread_hub)
+        if not hub:
+            return None
+        thread = await self.bot.outbound.run(lane, hub.create_thread(name=user_id, type=discord.ChannelType.private_thread, invitable=False, auto_archive_duration=THREAD_ARCHIVE_MINUTES), guild=member.guild)
+        self.record(user_key, thread)
+        await self.bot.outbound.run(lane, thread.add_user(member), guild=member.guild)
+        print(f"Created private thread {user_id} for {member}")
+        # Private threads have no overwrites: staff see them through Manage Threads on the hub,
+        # which MM setPrivateSpaces threads checks
+        await self.bot.outbound.run(lane, thread.send(RULES_MESSAGE.format(user_id=user_id)), guild=member.guild)
+        return thread
+
+    async def ensure(self, member, lane=BACKGROUND):
+        # The member's private channel or thread, created on first use when channels are lazy.
+        # None if the member has no ID yet or there is nowhere to create it.
+        user_key = str(member)
+        async with self._locks.setdefault((member.guild.id, user_key), asyncio.Lock()):
+            channel = await self.fetch(member.guild, user_key)
+            if isinstance(channel, discord.Thread) and channel.archived:
+                # The bot can't post in an archived thread until it is reopened
+                channel = await self.bot.outbound.run(lane, channel.edit(archived=False), guild=member.guild)
+            if channel:
+                return channel
+            record = self.guild_states.user_store(member.guild).get(user_key)
+            if not record:
+                return None
+            return await self.create(member, user_key, record["user_id"], lane=lane)
+
+    def _channel_count(self, category):
+        # Channels just created may not have reached the guild cache yet, so count them too
+        cached = {channel.id for channel in category.channels}
+        recent = self._recent.get(category.id)
+        if recent:
+            recent -= cached
+            return len(cached) + len(recent)
+        return len(cached)
+
+    async def _category_with_room(self, guild, lane):
+        # First category of the group with a free slot; when all are full, open the next overflow category
+        config = self.guild_states.config(guild)
+        categories = [guild.get_channel(category_id) for category_id in config.allowed_categories]
+        categories = [category for category in categories if category]
+        if not categories:
+            return None
+        for category in categories:
+            if self._channel_count(category) < CATEGORY_CHANNEL_LIMIT:
+                return category
+
+        base = categories[0]
+        name = f"{base.name}-{len(categories) + 1}"
+        category = await self.bot.outbound.run(lane, guild.create_category(name, overwrites=base.overwrites, position=categories[-1].position + 1), guild=guild)
+        config.update_infos(overflow_categories=list(config.overflow_categories) + [category.id])
+        print(f"Created overflow category {name} in {guild}")
+        return category
+
+    def on_channel_create(self, channel):
+        # Channels named after a pseudonym in the allowed category belong to that user
+        user_store = self.guild_states.user_store(channel.guild)
+        if not self.guild_states.config(channel.guild).is_allowed_category(channel.category_id) or channel.id in user_store.by_channel_id:
+            return
+        user_key, record = user_store.get_by_user_id(channel.name)
+        if record and not record.get("channel_id"):
+            self.record(user_key, channel)
+
+    def on_channel_delete(self, channel):
+        config = self.guild_states.config(channel.guild)
+        if channel.id in config.overflow_categories:
+            overflow = [category_id for category_id in config.overflow_categories if category_id != channel.id]
+            config.update_infos(overflow_categories=overflow)
+            return
+        self.on_channel_id_delete(channel.guild, channel.id)
+
+    def on_channel_id_delete(self, guild, channel_id):
+        # Also used for threads, whose delete event may only carry the ID
+        user_store = self.guild_states.user_store(guild)
+        user_key, _ = user_store.get_by_channel_id(channel_id)
+        if user_key:
+            user_store.update(user_key, channel_id=None)
+
+    def backfill(self, guild):
+        # One scan of the allowed categories to index channels created before IDs were recorded
+        user_store = self.guild_states.user_store(guild)
+        indexed = 0
+        for category_id in self.guild_states.config(guild).allowed_categories:
+            category = guild.get_channel(category_id)
+            if not category:
+                continue
+            for channel in category.channels:
+                user_key, record = user_store.get_by_user_id(channel.name)
+                if record and not record.get("channel_id") and channel.id not in user_store.by_channel_id:
+                    self.record(user_key, channel)
+                    indexed += 1
+        return indexed
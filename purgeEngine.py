@@ -0,0 +1,165 @@
+import asyncio
+import datetime
+import time
+import discord
+from outboundScheduler import BACKGROUND, PURGE
+
+# Discord only bulk-deletes messages younger than 14 days; keep a margin for slow purges
+BULK_DELETE_MAX_AGE = datetime.timedelta(days=14) - datetime.timedelta(minutes=5)
+BULK_DELETE_SIZE = 100
+# Messages too old for bulk delete go one at a time through this many workers
+SINGLE_DELETE_WORKERS = 3
+# Old messages waiting for a worker; when full the history scan waits, keeping memory bounded
+SINGLE_DELETE_BACKLOG = 100
+PROGRESS_INTERVAL = 3.0
+
+
+class PurgeFilter:
+    # Every criterion that is set must match; the time window is also passed to the history scan
+    def __init__(self, author_id=None, persona=None, pattern=None, has_attachments=False, before=None, after=None):
+        self.author_id = author_id
+        self.persona = persona
+        self.pattern = pattern
+        self.has_attachments = has_attachments
+        self.before = before
+        self.after = after
+
+    def __call__(self, message):
+        if self.author_id is not None and message.author.id != self.author_id:
+            return False
+        # Anonymous posts come from the bot's webhook under the user_xxx/admin_xxx name
+        if self.persona is not None and (message.webhook_id is None or message.author.name != self.persona):
+            return False
+        if self.pattern is not None and not self.pattern.search(message.content):
+            return False
+        if self.has_attachments and not message.attachments:
+            return False
+        return True
+
+
+class PurgeJob:
+    def __init__(self, channel, limit, predicate):
+        self.channel = channel
+        self.limit = limit
+        self.predicate = predicate
+        self.scanned = 0
+        self.matched = 0
+        self.deleted = 0
+        self.failed = 0
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class PurgeEngine:
+    def __init__(self, bot):
+        self.bot = bot
+        # channel_id -> running PurgeJob
+        self.jobs = {}
+
+    def running(self, channel_id):
+        return self.jobs.get(channel_id)
+
+    def cancel(self, channel_id):
+        job = self.jobs.get(channel_id)
+        if job is None:
+            return False
+        job.cancel()
+        return True
+
+    async def run(self, channel, limit=None, predicate=None, exclude=(), progress=None):
+        # Streams the channel history page by page, deleting as it goes, so only the current
+        # bulk batch and the single-delete backlog are ever held in memory.
+        # limit caps the number of matching messages deleted; predicate(message) filters them.
+        before = getattr(predicate, 'before', None)
+        after = getattr(predicate, 'after', None)
+        if channel.id in self.jobs:
+            raise RuntimeError(f"A purge is already running in {channel}")
+        job = PurgeJob(channel, limit, predicate)
+        self.jobs[channel.id] = job
+        exclude = set(exclude)
+
+        old_messages = asyncio.Queue(maxsize=SINGLE_DELETE_BACKLOG)
+        workers = [asyncio.create_task(self._single_delete_worker(job, old_messages)) for _ in range(SINGLE_DELETE_WORKERS)]
+        batch = []
+        last_progress = time.monotonic()
+        try:
+            # Newest first even with after: set, where discord.py would default to oldest first
+            async for message in channel.history(limit=None, before=before, after=after, oldest_first=False):
+                if job.cancelled:
+                    break
+                job.scanned += 1
+                if message.id in exclude or (predicate and not predicate(message)):
+                    continue
+                job.matched += 1
+
+                if self._bulk_deletable(message):
+                    batch.append(message)
+                    if len(batch) == BULK_DELETE_SIZE:
+                        await self._flush(job, batch, old_messages)
+                        batch = []
+                else:
+                    await old_messages.put(message)
+
+                if progress and time.monotonic() - last_progress >= PROGRESS_INTERVAL:
+                    last_progress = time.monotonic()
+                    await self._report(job, progress)
+                if job.limit is not None and job.matched >= job.limit:
+                    break
+
+            if not job.cancelled:
+                await self._flush(job, batch, old_messages)
+                await old_messages.join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            del self.jobs[channel.id]
+        return job
+
+    def _bulk_deletable(self, message):
+        return discord.utils.utcnow() - message.created_at < BULK_DELETE_MAX_AGE
+
+    async def _flush(self, job, batch, old_messages):
+        # Messages that aged past the bulk window while buffered go to the single-delete lane
+        young = []
+        for message in batch:
+            if self._bulk_deletable(message):
+                young.append(message)
+            else:
+                await old_messages.put(message)
+        if not young:
+            return
+        try:
+            await self.bot.outbound.run(PURGE, job.channel.delete_messages(young), guild=job.channel.guild)
+            job.deleted += len(young)
+        except discord.NotFound:
+            # Only raised for a single message that is already gone
+            pass
+        except discord.Forbidden:
+            raise
+        except discord.HTTPException as e:
+            print(f"Bulk delete of {len(young)} messages in {job.channel} failed: {e}")
+            job.failed += len(young)
+
+    async def _single_delete_worker(self, job, old_messages):
+        while True:
+            message = await old_messages.get()
+            try:
+                if not job.cancelled:
+                    await self.bot.outbound.run(PURGE, message.delete(), guild=job.channel.guild)
+                    job.deleted += 1
+            except discord.NotFound:
+                pass
+            except discord.HTTPException as e:
+                print(f"Deleting message {message.id} in {job.channel} failed: {e}")
+                job.failed += 1
+            finally:
+                old_messages.task_done()
+
+    async def _report(self, job, progress):
+        try:
+            await self.bot.outbound.run(BACKGROUND, progress.edit(content=f"Purging {job.channel.mention}: scanned {job.scanned}, deleted {job.deleted}..."), guild=job.channel.guild)
+        except discord.HTTPException:
+            pass
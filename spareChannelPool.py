@@ -0,0 +1,108 @@
+import asyncio
+import secrets
+import time
+import discord
+from outboundScheduler import BACKGROUND
+
+# Spare channels are named with this prefix until a member claims one
+SPARE_PREFIX = "spare-"
+# How often the maintainer checks whether the pool needs topping up
+CHECK_INTERVAL = 10.0
+
+
+class SpareChannelPool:
+    def __init__(self, bot):
+        self.bot = bot
+        self.guild_states = bot.guild_states
+        self.metrics = bot.metrics
+        # guild_id -> IDs of spare channels, oldest first
+        self._spares = {}
+        # guild_id -> monotonic time before which the guild gets no new spare
+        self._next_due = {}
+        self._task = None
+
+    def size(self, guild):
+        return len(self._spares.get(guild.id, ()))
+
+    def discover(self, guild):
+        # Adopt the spares left by a previous run
+        spares = self._spares.setdefault(guild.id, [])
+        for category_id in self.guild_states.config(guild).allowed_categories:
+            category = guild.get_channel(category_id)
+            if not category:
+                continue
+            for channel in category.text_channels:
+                if channel.name.startswith(SPARE_PREFIX) and channel.id not in spares:
+                    spares.append(channel.id)
+        return len(spares)
+
+    def claim(self, guild):
+        # A spare text channel still in an allowed category, or None if the pool is empty
+        config = self.guild_states.config(guild)
+        if config.thread_mode:
+            return None
+        spares = self._spares.get(guild.id)
+        while spares:
+            channel = guild.get_channel(spares.pop(0))
+            if channel and config.is_allowed_category(channel.category_id):
+                self.metrics.incr("spare_pool.claimed")
+                return channel
+        self.metrics.incr("spare_pool.empty")
+        return None
+
+    def on_channel_delete(self, channel):
+        spares = self._spares.get(channel.guild.id)
+        if spares and channel.id in spares:
+            spares.remove(channel.id)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._maintain())
+
+    def _quiet(self, guild):
+        # Refill only when the guild is not absorbing a join burst
+        provisioner = self.bot.channel_provisioner
+        return not provisioner.bursting(guild) and not provisioner.pending(guild)
+
+    def _due(self, now):
+        # Loaded guilds below their target whose refill interval has passed
+        due = []
+        for guild, state in self.guild_states.loaded():
+            config = state.config
+            if self._next_due.get(guild.id, 0) > now:
+                continue
+            if config.spare_pool_size and not config.thread_mode and self.size(guild) < config.spare_pool_size and self._quiet(guild):
+                due.append(guild)
+        return due
+
+    def _delay(self, now):
+        # Sleep until the next guild's refill interval ends, checking at least every CHECK_INTERVAL
+        for guild_id, due in list(self._next_due.items()):
+            if due <= now:
+                del self._next_due[guild_id]
+        return min([due - now for due in self._next_due.values()] + [CHECK_INTERVAL])
+
+    async def _maintain(self):
+        while True:
+            delay = CHECK_INTERVAL
+            try:
+                for guild in self._due(time.monotonic()):
+                    # One spare per refill interval keeps each guild's pool from competing with its real work
+                    self._next_due[guild.id] = time.monotonic() + self.guild_states.config(guild).spare_pool_refill_seconds
+                    await self._add_spare(guild)
+                delay = self._delay(time.monotonic())
+            except Exception as e:
+                print(f"Error refilling spare channels: {e}")
+            await asyncio.sleep(delay)
+
+    async def _add_spare(self, guild):
+        # Locked down to staff until claimed
+        overwrites = self.bot.private_channels.overwrites(guild)
+        try:
+            channel = await self.bot.private_channels.create_in_group(guild, SPARE_PREFIX + secrets.token_hex(3), overwrites, BACKGROUND)
+        except discord.HTTPException as e:
+            print(f"Could not create a spare channel in {guild}: {e}")
+            return
+        if channel:
+            self._spares.setdefault(guild.id, []).append(channel.id)
+            self.metrics.incr("spare_pool.created")
@@ -1,21 +1,19 @@
 import discord
 import os
-import json
 import datetime
-import random
-import string
 from discord.ext import commands
-from config import ALLOWED_CATEGORY_ID, ALLOWED_ROLE_ID, SUPER_ADMIN_ROLE_ID, MEMBER_ROLE_ID, USER_IDS_FILE, CONFIG_FILE, INFOS_FILE
 
 class SuperAdminCmd(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        self.guild_states = bot.guild_states
+        self.permissions = bot.permissions
 
     @commands.command(name='makeCategory')
     async def make_category(self, ctx, category_name: str, admin_only: str = None):
-        global ALLOWED_CATEGORY_ID, ALLOWED_ROLE_ID, SUPER_ADMIN_ROLE_ID, MEMBER_ROLE_ID
+        config = self.guild_states.config(ctx.guild)
         # Check if user has super admin role
-        if not any(role.id == SUPER_ADMIN_ROLE_ID for role in ctx.author.roles):
+        if not self.permissions.is_super_admin(ctx.author):
             await ctx.send("You are not allowed to use this command.")
             return
 
@@ -30,8 +28,8 @@ class SuperAdminCmd(commands.Cog):
             # Restrict to admins and super admins only
             overwrites = {
                 ctx.guild.default_role: discord.PermissionOverwrite(view_channel=False),
-                ctx.guild.get_role(ALLOWED_ROLE_ID[0]): discord.PermissionOverwrite(view_channel=True),
-                ctx.guild.get_role(SUPER_ADMIN_ROLE_ID): discord.PermissionOverwrite(view_channel=True)
+                ctx.guild.get_role(config.admin_roles[0]): discord.PermissionOverwrite(view_channel=True),
+                ctx.guild.get_role(config.super_admin_role): discord.PermissionOverwrite(view_channel=True)
             }
 
         try:
@@ -42,9 +40,8 @@ class SuperAdminCmd(commands.Cog):
 
     @commands.command(name='removeCategory')
     async def remove_category(self, ctx, category_name: str):
-        global ALLOWED_CATEGORY_ID, ALLOWED_ROLE_ID, SUPER_ADMIN_ROLE_ID, MEMBER_ROLE_ID
         # Check if user has super admin role
-        if not any(role.id == SUPER_ADMIN_ROLE_ID for role in ctx.author.roles):
+        if not self.permissions.is_super_admin(ctx.author):
             await ctx.send("You are not allowed to use this command.")
             return
 
@@ -62,51 +59,41 @@ class SuperAdminCmd(commands.Cog):
 
     @commands.command(name='removeAdmin')
     async def remove_admin(self, ctx, user: discord.Member):
-        global ALLOWED_CATEGORY_ID, ALLOWED_ROLE_ID, SUPER_ADMIN_ROLE_ID, MEMBER_ROLE_ID
+        config = self.guild_states.config(ctx.guild)
         # Check if member roles are set
-        if not MEMBER_ROLE_ID:
+        if not config.member_roles:
             await ctx.send("Member roles must be set before using this command.")
             return
 
         # Check if admin roles are set
-        if not ALLOWED_ROLE_ID:
+        if not config.admin_roles:
             await ctx.send("Admin roles must be set before using this command.")
             return
 
         # Check if executor has super admin role
-        if not any(role.id == SUPER_ADMIN_ROLE_ID for role in ctx.author.roles):
+        if not self.permissions.is_super_admin(ctx.author):
             await ctx.send("You are not allowed to use this command.")
             return
 
         # Check if target has super admin role
-        if any(role.id == SUPER_ADMIN_ROLE_ID for role in user.roles):
+        if self.permissions.is_super_admin(user):
             await ctx.send("You cannot remove admin privileges from a super admin.")
             return
 
-        # Load existing user IDs
-        try:
-            with open(USER_IDS_FILE, 'r') as f:
-                user_ids = json.load(f)
-        except FileNotFoundError:
-            await ctx.send("No user data found.")
-            return
-
+        # Load existing user data
+        user_store = self.guild_states.user_store(ctx.guild)
         user_key = str(user)
-        if user_key not in user_ids:
+        data = user_store.get(user_key)
+        if not data:
             await ctx.send("User not found in database.")
             return
 
-        data = user_ids[user_key]
-        if isinstance(data, str):
-            await ctx.send("User data is in old format. Please have them use MM generateID to migrate.")
-            return
-
         if data["role"] != "admin":
             await ctx.send("User is not an admin.")
             return
 
         # Remove admin role from user
-        admin_role = discord.utils.get(ctx.guild.roles, id=ALLOWED_ROLE_ID[0])
+        admin_role = discord.utils.get(ctx.guild.roles, id=config.admin_roles[0])
         if admin_role:
             try:
                 await user.remove_roles(admin_role)
@@ -118,55 +105,36 @@ class SuperAdminCmd(commands.Cog):
                 return
 
         # Change role to user and remove admin_id
-        data["role"] = "user"
-        data["admin_id"] = None
-        role_history = data.get("role_history", [])
-        role_history.append({"role": "user", "timestamp": datetime.datetime.now().isoformat()})
-        data["role_history"] = role_history
-
-        # Write back to file
-        with open(USER_IDS_FILE, 'w') as f:
-            json.dump(user_ids, f, indent=4)
+        user_store.set_role(user_key, "user", admin_id=None)
 
         await ctx.send(f"Removed admin privileges from {user.mention}.")
 
     @commands.command(name='makeAdmin')
     async def make_admin(self, ctx, user: discord.Member):
-        global ALLOWED_CATEGORY_ID, ALLOWED_ROLE_ID, SUPER_ADMIN_ROLE_ID, MEMBER_ROLE_ID
         # Check if executor has super admin role
-        if not any(role.id == SUPER_ADMIN_ROLE_ID for role in ctx.author.roles):
+        if not self.permissions.is_super_admin(ctx.author):
             await ctx.send("You are not allowed to use this command.")
             return
 
         # Check if target has super admin role
-        if any(role.id == SUPER_ADMIN_ROLE_ID for role in user.roles):
+        if self.permissions.is_super_admin(user):
             await ctx.send("You cannot grant admin privileges to a super admin.")
             return
 
-        # Load existing user IDs
-        try:
-            with open(USER_IDS_FILE, 'r') as f:
-                user_ids = json.load(f)
-        except FileNotFoundError:
-            await ctx.send("No user data found.")
-            return
-
+        # Load existing user data
+        user_store = self.guild_states.user_store(ctx.guild)
         user_key = str(user)
-        if user_key not in user_ids:
+        data = user_store.get(user_key)
+        if not data:
             await ctx.send("User not found in database.")
             return
 
-        data = user_ids[user_key]
-        if isinstance(data, str):
-            await ctx.send("User data is in old format. Please have them use MM generateID to migrate.")
-            return
-
         if data["role"] == "admin":
             await ctx.send("User is already an admin.")
             return
 
         # Add admin role to user
-        admin_role = discord.utils.get(ctx.guild.roles, id=ALLOWED_ROLE_ID[0])
+        admin_role = discord.utils.get(ctx.guild.roles, id=self.guild_states.config(ctx.guild).admin_roles[0])
         if admin_role:
             try:
                 await user.add_roles(admin_role)
@@ -178,52 +146,26 @@ class SuperAdminCmd(commands.Cog):
                 return
 
         # Generate admin_id
-        existing_ids = set()
-        for d in user_ids.values():
-            if isinstance(d, dict):
-                existing_ids.add(d.get("user_id"))
-                if d.get("admin_id"):
-                    existing_ids.add(d.get("admin_id"))
-            elif isinstance(d, str):
-                existing_ids.add(d)
-        admin_id = ''.join(random.choices(string.ascii_letters + string.digits, k=12))
-        while admin_id in existing_ids or admin_id == data["user_id"]:
-            admin_id = ''.join(random.choices(string.ascii_letters + string.digits, k=12))
+        admin_id = user_store.allocate_id()
 
         # Update data
-        data["role"] = "admin"
-        data["admin_id"] = admin_id
-        role_history = data.get("role_history", [])
-        role_history.append("admin")
-        data["role_history"] = role_history
-
-        # Write back to file
-        with open(USER_IDS_FILE, 'w') as f:
-            json.dump(user_ids, f, indent=4)
+        user_store.set_role(user_key, "admin", admin_id=admin_id)
 
         await ctx.send(f"Granted admin privileges to {user.mention}. Admin ID: {admin_id}")
 
     @commands.command(name='displayAdminRoleHistory')
     async def display_admin_role_history(self, ctx):
-        global ALLOWED_CATEGORY_ID, ALLOWED_ROLE_ID, SUPER_ADMIN_ROLE_ID, MEMBER_ROLE_ID
         # Check if executor has super admin role
-        if not any(role.id == SUPER_ADMIN_ROLE_ID for role in ctx.author.roles):
+        if not self.permissions.is_super_admin(ctx.author):
             await ctx.send("You are not allowed to use this command.")
             return
 
-        try:
-            with open(USER_IDS_FILE, 'r') as f:
-                user_ids = json.load(f)
-        except FileNotFoundError:
-            await ctx.send("No user data found.")
-            return
-
         embed = discord.Embed(title="Admin Role History", color=0xff0000)
 
         now = datetime.datetime.now()
 
-        for user_key, data in user_ids.items():
-            if isinstance(data, dict) and data.get("role_history"):
+        for user_key, data in self.guild_states.user_store(ctx.guild).items():
+            if data.get("role_history"):
                 role_history = data["role_history"]
                 admin_timestamps = []
                 for entry in role_history:
@@ -246,52 +188,30 @@ class SuperAdminCmd(commands.Cog):
 
     @commands.command(name='setWelcomeHere')
     async def set_welcome_here(self, ctx):
-        global ALLOWED_CATEGORY_ID, ALLOWED_ROLE_ID, SUPER_ADMIN_ROLE_ID, MEMBER_ROLE_ID
         # Check if executor has super admin role
-        if not any(role.id == SUPER_ADMIN_ROLE_ID for role in ctx.author.roles):
+        if not self.permissions.is_super_admin(ctx.author):
             await ctx.send("You are not allowed to use this command.")
             return
 
-        # Load config
-        try:
-            with open(CONFIG_FILE, 'r') as f:
-                config = json.load(f)
-        except FileNotFoundError:
-            config = {}
-
-        # Set welcome channel
-        config['welcome_channel'] = ctx.channel.id
-
-        # Write back to file
-        with open(CONFIG_FILE, 'w') as f:
-            json.dump(config, f, indent=4)
+        # Set welcome channel and write it back
+        self.guild_states.config(ctx.guild).update_config(welcome_channel=ctx.channel.id)
 
         # Send welcome message in the channel
         await ctx.send("Welcome channel set to this channel.")
 
     @commands.command(name='setRole')
     async def set_role(self, ctx, role_type: str, *, roles: str = None):
-        global ALLOWED_CATEGORY_ID, ALLOWED_ROLE_ID, SUPER_ADMIN_ROLE_ID, MEMBER_ROLE_ID
-        # Reload infos to ensure up to date
-        try:
-            with open(INFOS_FILE, 'r') as f:
-                infos = json.load(f)
-            ALLOWED_CATEGORY_ID = infos.get("allowed_category")
-            ALLOWED_ROLE_ID = infos.get("admin_roles", [])
-            SUPER_ADMIN_ROLE_ID = infos.get("super_admin_role")
-            MEMBER_ROLE_ID = infos.get("member_roles", [])
-        except Exception as e:
-            print(f"Error reloading infos in setRole: {e}")
+        config = self.guild_states.config(ctx.guild)
 
         # Check if super admin is set
-        if SUPER_ADMIN_ROLE_ID is None:
+        if config.super_admin_role is None:
             if role_type.lower() != 'superadmin':
                 await ctx.send("No super admin role set. Only MM setRole superAdmin is allowed.")
                 return
             # Allow anyone to set superAdmin if not set
         else:
             # Check if user is super admin
-            if not any(role.id == SUPER_ADMIN_ROLE_ID for role in ctx.author.roles):
+            if not self.permissions.is_super_admin(ctx.author):
                 await ctx.send("You are not allowed to use this command.")
                 return
 
@@ -316,12 +236,8 @@ class SuperAdminCmd(commands.Cog):
             await ctx.send("No valid roles found.")
             return
 
-        # Load infos
-        try:
-            with open(INFOS_FILE, 'r') as f:
-                infos = json.load(f)
-        except FileNotFoundError:
-            infos = {"admin_roles": [], "super_admin_role": None, "member_roles": [], "allowed_category": None}
+        # Start from the cached infos
+        infos = dict(config.infos)
 
         if role_type.lower() == 'superadmin':
             if len(role_ids) != 1:
@@ -336,27 +252,22 @@ class SuperAdminCmd(commands.Cog):
             await ctx.send("Invalid role type. Use superAdmin, admin, or member.")
             return
 
-        # Save infos
-        with open(INFOS_FILE, 'w') as f:
-            json.dump(infos, f, indent=4)
+        # Save infos and update the cached snapshot
+        config.update_infos(**infos)
 
-        ALLOWED_CATEGORY_ID = infos.get("allowed_category")
-        ALLOWED_ROLE_ID = infos.get("admin_roles", [])
-        SUPER_ADMIN_ROLE_ID = infos.get("super_admin_role")
-        MEMBER_ROLE_ID = infos.get("member_roles", [])
 
         await ctx.send(f"Set {role_type} roles successfully.")
 
     @commands.command(name='addRole')
     async def add_role(self, ctx, role_type: str, *, roles: str = None):
-        global ALLOWED_CATEGORY_ID, ALLOWED_ROLE_ID, SUPER_ADMIN_ROLE_ID, MEMBER_ROLE_ID
+        config = self.guild_states.config(ctx.guild)
         # Check if super admin is set
-        if SUPER_ADMIN_ROLE_ID is None:
+        if config.super_admin_role is None:
             await ctx.send("No super admin role set. Cannot use this command.")
             return
 
         # Check if user is super admin
-        if not any(role.id == SUPER_ADMIN_ROLE_ID for role in ctx.author.roles):
+        if not self.permissions.is_super_admin(ctx.author):
             await ctx.send("You are not allowed to use this command.")
             return
 
@@ -381,21 +292,17 @@ class SuperAdminCmd(commands.Cog):
             await ctx.send("No valid roles found.")
             return
 
-        # Load infos
-        try:
-            with open(INFOS_FILE, 'r') as f:
-                infos = json.load(f)
-        except FileNotFoundError:
-            infos = {"admin_roles": [], "super_admin_role": None, "member_roles": [], "allowed_category": None}
+        # Start from the cached infos
+        infos = dict(config.infos)
 
         if role_type.lower() == 'admin':
-            current = infos.get("admin_roles", [])
+            current = list(infos.get("admin_roles", []))
             for rid in role_ids:
                 if rid not in current:
                     current.append(rid)
             infos["admin_roles"] = current
         elif role_type.lower() == 'member':
-            current = infos.get("member_roles", [])
+            current = list(infos.get("member_roles", []))
             for rid in role_ids:
                 if rid not in current:
                     current.append(rid)
@@ -404,26 +311,21 @@ class SuperAdminCmd(commands.Cog):
             await ctx.send("Invalid role type. Use admin or member.")
             return
 
-        # Save infos
-        with open(INFOS_FILE, 'w') as f:
-            json.dump(infos, f, indent=4)
-        ALLOWED_CATEGORY_ID = infos.get("allowed_category")
-        ALLOWED_ROLE_ID = infos.get("admin_roles", [])
-        SUPER_ADMIN_ROLE_ID = infos.get("super_admin_role")
-        MEMBER_ROLE_ID = infos.get("member_roles", [])
+        # Save infos and update the cached snapshot
+        config.update_infos(**infos)
 
         await ctx.send(f"Added roles to {role_type} successfully.")
 
     @commands.command(name='removeFromRole')
     async def remove_from_role(self, ctx, role_type: str, *, roles: str = None):
-        global ALLOWED_CATEGORY_ID, ALLOWED_ROLE_ID, SUPER_ADMIN_ROLE_ID, MEMBER_ROLE_ID
+        config = self.guild_states.config(ctx.guild)
         # Check if super admin is set
-        if SUPER_ADMIN_ROLE_ID is None:
+        if config.super_admin_role is None:
             await ctx.send("No super admin role set. Cannot use this command.")
             return
 
         # Check if user is super admin
-        if not any(role.id == SUPER_ADMIN_ROLE_ID for role in ctx.author.roles):
+        if not self.permissions.is_super_admin(ctx.author):
             await ctx.send("You are not allowed to use this command.")
             return
 
@@ -448,44 +350,35 @@ class SuperAdminCmd(commands.Cog):
             await ctx.send("No valid roles found.")
             return
 
-        # Load infos
-        try:
-            with open(INFOS_FILE, 'r') as f:
-                infos = json.load(f)
-        except FileNotFoundError:
-            infos = {"admin_roles": [], "super_admin_role": None, "member_roles": [], "allowed_category": None}
+        # Start from the cached infos
+        infos = dict(config.infos)
 
         if role_type.lower() == 'admin':
-            current = infos.get("admin_roles", [])
+            current = list(infos.get("admin_roles", []))
             infos["admin_roles"] = [rid for rid in current if rid not in role_ids]
         elif role_type.lower() == 'member':
-            current = infos.get("member_roles", [])
+            current = list(infos.get("member_roles", []))
             infos["member_roles"] = [rid for rid in current if rid not in role_ids]
         else:
             await ctx.send("Invalid role type. Use admin or member.")
             return
 
-        # Save infos
-        with open(INFOS_FILE, 'w') as f:
-            json.dump(infos, f, indent=4)
+        # Save infos and update the cached snapshot
+        config.update_infos(**infos)
 
-        ALLOWED_CATEGORY_ID = infos.get("allowed_category")
-        ALLOWED_ROLE_ID = infos.get("admin_roles", [])
-        SUPER_ADMIN_ROLE_ID = infos.get("super_admin_role")
-        MEMBER_ROLE_ID = infos.get("member_roles", [])
 
         await ctx.send(f"Removed roles from {role_type} successfully.")
 
     @commands.command(name='setAllowedCategory')
     async def set_allowed_category(self, ctx):
-        global ALLOWED_CATEGORY_ID, ALLOWED_ROLE_ID, SUPER_ADMIN_ROLE_ID, MEMBER_ROLE_ID
+        config = self.guild_states.config(ctx.guild)
         # Check if super admin is set
-        if SUPER_ADMIN_ROLE_ID is None:
+        if config.super_admin_role is None:
             await ctx.send("No super admin role set. Cannot use this command.")
             return
 
         # Check if user is super admin
-        if not any(role.id == SUPER_ADMIN_ROLE_ID for role in ctx.author.roles):
+        if not self.permissions.is_super_admin(ctx.author):
             await ctx.send("You are not allowed to use this command.")
             return
 
@@ -495,25 +388,122 @@ class SuperAdminCmd(commands.Cog):
 
         category_id = ctx.channel.category.id
 
-        # Load infos
-        try:
-            with open(INFOS_FILE, 'r') as f:
-                infos = json.load(f)
-        except FileNotFoundError:
-            infos = {"admin_roles": [], "super_admin_role": None, "member_roles": [], "allowed_category": None}
+        # Start from the cached infos
+        infos = dict(config.infos)
 
         infos["allowed_category"] = category_id
+        # Overflow categories belonged to the previous allowed category
+        if category_id != config.allowed_category:
+            infos["overflow_categories"] = []
 
-        # Save infos
-        with open(INFOS_FILE, 'w') as f:
-            json.dump(infos, f, indent=4)
+        # Save infos and update the cached snapshot
+        config.update_infos(**infos)
 
-        ALLOWED_CATEGORY_ID = infos.get("allowed_category")
-        ALLOWED_ROLE_ID = infos.get("admin_roles", [])
-        SUPER_ADMIN_ROLE_ID = infos.get("super_admin_role")
-        MEMBER_ROLE_ID = infos.get("member_roles", [])
 
         await ctx.send(f"Set allowed category to {ctx.channel.category.name}.")
 
+    @commands.command(name='setLazyChannels')
+    async def set_lazy_channels(self, ctx, mode: str = None):
+        # Check if executor has super admin role
+        if not self.permissions.is_super_admin(ctx.author):
+            await ctx.send("You are not allowed to use this command.")
+            return
+
+        if mode is None or mode.lower() not in ('on', 'off'):
+            await ctx.send("Usage: MM setLazyChannels <on|off>")
+            return
+
+        lazy = mode.lower() == 'on'
+        self.guild_states.config(ctx.guild).update_config(lazy_channels=lazy)
+        if lazy:
+            await ctx.send("Private channels will be created on first use (MM openChannel or an admin action).")
+        else:
+            await ctx.send("Private channels will be created when members join.")
+
+    @commands.command(name='setPrivateSpaces')
+    async def set_private_spaces(self, ctx, mode: str = None):
+        config = self.guild_states.config(ctx.guild)
+        # Check if executor has super admin role
+        if not self.permissions.is_super_admin(ctx.author):
+            await ctx.send("You are not allowed to use this command.")
+            return
+
+        if mode is None or mode.lower() not in ('channels', 'threads'):
+            await ctx.send("Usage: MM setPrivateSpaces <channels|threads>")
+            return
+
+        if mode.lower() == 'threads':
+            if not isinstance(ctx.channel, discord.TextChannel):
+                await ctx.send("Run this in the text channel that should hold the private threads.")
+                return
+            # Private threads have no overwrites: staff see them through Manage Threads on the hub
+            staff_roles = [ctx.guild.get_role(role_id) for role_id in config.admin_roles + [config.super_admin_role]]
+            missing = []
+            for role in staff_roles:
+                if role:
+                    permissions = ctx.channel.permissions_for(role)
+                    if not (permissions.view_channel and permissions.manage_threads):
+                        missing.append(role.name)
+            if missing:
+                await ctx.send(f"Staff roles need View Channel and Manage Threads in {ctx.channel.mention} to see private threads. Missing for: "
+                               + ", ".join(missing))
+                return
+            # Existing private channels keep working; only new spaces become threads
+            config.update_config(private_spaces="threads", thread_hub=ctx.channel.id)
+            await ctx.send(f"New private spaces will be private threads in {ctx.channel.mention}. Staff roles see them through their Manage Threads permission there.")
+        else:
+            config.update_config(private_spaces="channels")
+            await ctx.send("New private spaces will be channels in the allowed category.")
+
+    @commands.command(name='setSparePool')
+    async def set_spare_pool(self, ctx, size: int = None, refill_seconds: int = None):
+        config = self.guild_states.config(ctx.guild)
+        # Check if executor has super admin role
+        if not self.permissions.is_super_admin(ctx.author):
+            await ctx.send("You are not allowed to use this command.")
+            return
+
+        if size is None or size < 0 or (refill_seconds is not None and refill_seconds < 1):
+            await ctx.send(f"Usage: MM setSparePool <size> [refill_seconds]\nCurrently {config.spare_pool_size} spares, one every {config.spare_pool_refill_seconds}s.")
+            return
+
+        changes = {"spare_pool_size": size}
+        if refill_seconds is not None:
+            changes["spare_pool_refill_seconds"] = refill_seconds
+        config.update_config(**changes)
+        await ctx.send(f"Keeping {size} spare private channels ready, creating one every {config.spare_pool_refill_seconds}s when joins are quiet.")
+
+    @commands.command(name='setArchiving')
+    async def set_archiving(self, ctx, idle_days: int = None, max_live_channels: int = None):
+        config = self.guild_states.config(ctx.guild)
+        # Check if executor has super admin role
+        if not self.permissions.is_super_admin(ctx.author):
+            await ctx.send("You are not allowed to use this command.")
+            return
+
+        if idle_days is None or idle_days < 0 or (max_live_channels is not None and max_live_channels < 0):
+            await ctx.send(f"Usage: MM setArchiving <idle_days> [max_live_channels]\nCurrently {config.archive_idle_days} idle days, at most {config.max_live_channels} live channels (0 = off).")
+            return
+
+        changes = {"archive_idle_days": idle_days}
+        if max_live_channels is not None:
+            changes["max_live_channels"] = max_live_channels
+        config.update_config(**changes)
+        await ctx.send(f"Archiving private channels idle for {idle_days} days (0 = never), keeping at most {config.max_live_channels} live (0 = unlimited).")
+
+    @commands.command(name='showMetrics')
+    async def show_metrics(self, ctx):
+        # Check if user is super admin
+        if not self.permissions.is_super_admin(ctx.author):
+            await ctx.send("You are not allowed to use this command.")
+            return
+
+        counters = self.bot.metrics.snapshot()
+        if not counters:
+            await ctx.send("No metrics recorded yet.")
+            return
+        lines = [f"{name}: {value}" for name, value in counters.items()]
+        await ctx.send("```" + "\n".join(lines) + "```")
+
 async def setup(bot):
     await bot.add_cog(SuperAdminCmd(bot))
@@ -0,0 +1,36 @@
+import tempfile
+import unittest
+
+from guildState import GuildStates
+
+
+class ShardLockTest(unittest.TestCase):
+    def setUp(self):
+        self.base_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.base_dir.cleanup)
+
+    def test_overlapping_shards_refused(self):
+        first = GuildStates(None, base_dir=self.base_dir.name)
+        first.lock_shards(4, [0, 1])
+        self.addCleanup(first.close)
+
+        second = GuildStates(None, base_dir=self.base_dir.name)
+        self.addCleanup(second.close)
+        with self.assertRaisesRegex(RuntimeError, "Shard 1 of 4"):
+            second.lock_shards(4, [1, 2])
+
+    def test_disjoint_shards_and_released_locks(self):
+        first = GuildStates(None, base_dir=self.base_dir.name)
+        first.lock_shards(4, [0, 1])
+        second = GuildStates(None, base_dir=self.base_dir.name)
+        second.lock_shards(4, [2, 3])
+        second.close()
+
+        first.close()
+        third = GuildStates(None, base_dir=self.base_dir.name)
+        third.lock_shards(4, [0, 1])
+        third.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
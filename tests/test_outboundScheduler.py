@@ -0,0 +1,76 @@
+import asyncio
+import unittest
+
+from metrics import Metrics
+from outboundScheduler import OutboundScheduler, INTERACTIVE, MODERATION, BACKGROUND, PURGE
+
+
+class OutboundSchedulerTest(unittest.IsolatedAsyncioTestCase):
+    async def test_cancelled_waiter_does_not_leak_slot(self):
+        scheduler = OutboundScheduler(Metrics(), max_in_flight=1, lane_limits={INTERACTIVE: 1, MODERATION: 1, BACKGROUND: 1, PURGE: 1})
+        release = asyncio.Event()
+
+        async def hold():
+            await release.wait()
+            return "held"
+
+        holder = asyncio.create_task(scheduler.run(BACKGROUND, hold()))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(scheduler.run(BACKGROUND, asyncio.sleep(0)))
+        await asyncio.sleep(0)
+
+        # The holder is woken first, so it frees its slot after the queued call is cancelled
+        # but before the cancelled task has run to take itself out of the queue
+        release.set()
+        waiter.cancel()
+        self.assertEqual(await holder, "held")
+        with self.assertRaises(asyncio.CancelledError):
+            await waiter
+
+        self.assertEqual(scheduler._budgets, {})
+        self.assertEqual(await scheduler.run(BACKGROUND, asyncio.sleep(0, "next")), "next")
+
+    async def test_interactive_served_before_background(self):
+        scheduler = OutboundScheduler(Metrics(), max_in_flight=1)
+        release = asyncio.Event()
+        order = []
+
+        async def record(name):
+            order.append(name)
+
+        holder = asyncio.create_task(scheduler.run(BACKGROUND, release.wait()))
+        await asyncio.sleep(0)
+        background = asyncio.create_task(scheduler.run(BACKGROUND, record("background")))
+        interactive = asyncio.create_task(scheduler.run(INTERACTIVE, record("interactive")))
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(holder, background, interactive)
+        self.assertEqual(order, ["interactive", "background"])
+
+    async def test_busy_guild_does_not_block_other_guilds(self):
+        scheduler = OutboundScheduler(Metrics())
+        release = asyncio.Event()
+        stuck = [asyncio.create_task(scheduler.run(MODERATION, release.wait(), guild=1)) for _ in range(5)]
+        await asyncio.sleep(0)
+        self.assertEqual(scheduler._budgets[1].lane_in_flight[MODERATION], 3)
+
+        other = await asyncio.wait_for(scheduler.run(MODERATION, asyncio.sleep(0, "other"), guild=2), 1)
+        self.assertEqual(other, "other")
+        release.set()
+        await asyncio.gather(*stuck)
+        self.assertEqual(scheduler._budgets, {})
+
+    async def test_purge_does_not_block_moderation(self):
+        scheduler = OutboundScheduler(Metrics())
+        release = asyncio.Event()
+        purge = [asyncio.create_task(scheduler.run(PURGE, release.wait(), guild=1)) for _ in range(10)]
+        await asyncio.sleep(0)
+
+        gate = await asyncio.wait_for(scheduler.run(MODERATION, asyncio.sleep(0, "deleted"), guild=1), 1)
+        self.assertEqual(gate, "deleted")
+        release.set()
+        await asyncio.gather(*purge)
+
+
+if __name__ == "__main__":
+    unittest.main()
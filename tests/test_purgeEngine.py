@@ -0,0 +1,161 @@
+import datetime
+import re
+import unittest
+
+import discord
+
+from adminCmd import AdminCmd
+from metrics import Metrics
+from outboundScheduler import OutboundScheduler
+from purgeEngine import PurgeEngine, PurgeFilter, BULK_DELETE_SIZE
+
+
+class FakeAuthor:
+    def __init__(self, author_id, name):
+        self.id = author_id
+        self.name = name
+
+
+class FakeMessage:
+    def __init__(self, channel, message_id, age, author=None, content="", webhook_id=None, attachments=()):
+        self.channel = channel
+        self.id = message_id
+        self.created_at = discord.utils.utcnow() - age
+        self.author = author or FakeAuthor(1, "someone")
+        self.content = content
+        self.webhook_id = webhook_id
+        self.attachments = list(attachments)
+
+    async def delete(self):
+        self.channel.single_deletes.append(self.id)
+
+
+class FakeChannel:
+    def __init__(self):
+        self.id = 10
+        self.guild = None
+        self.mention = "#test"
+        self.messages = []
+        self.bulk_deletes = []
+        self.single_deletes = []
+        self.history_args = None
+
+    def add(self, age, **kwargs):
+        message = FakeMessage(self, len(self.messages) + 1, age, **kwargs)
+        self.messages.append(message)
+        return message
+
+    async def history(self, limit=None, before=None, after=None, oldest_first=None):
+        self.history_args = {"before": before, "after": after, "oldest_first": oldest_first}
+        for message in sorted(self.messages, key=lambda message: message.created_at, reverse=True):
+            yield message
+
+    async def delete_messages(self, messages):
+        self.bulk_deletes.append([message.id for message in messages])
+
+
+class FakeGuildStates:
+    def subscribe(self, callback):
+        pass
+
+
+class FakeBot:
+    def __init__(self):
+        self.outbound = OutboundScheduler(Metrics())
+        self.guild_states = FakeGuildStates()
+        self.permissions = None
+
+
+def deleted(channel):
+    return sorted(sum(channel.bulk_deletes, []) + channel.single_deletes)
+
+
+class PurgeEngineTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.engine = PurgeEngine(FakeBot())
+        self.channel = FakeChannel()
+
+    async def test_young_messages_bulk_deleted_old_ones_singly(self):
+        young = [self.channel.add(datetime.timedelta(hours=index + 1)) for index in range(BULK_DELETE_SIZE + 5)]
+        old = [self.channel.add(datetime.timedelta(days=20 + index)) for index in range(3)]
+
+        job = await self.engine.run(self.channel)
+
+        self.assertEqual([len(batch) for batch in self.channel.bulk_deletes], [BULK_DELETE_SIZE, 5])
+        self.assertEqual(sorted(sum(self.channel.bulk_deletes, [])), sorted(message.id for message in young))
+        self.assertEqual(sorted(self.channel.single_deletes), sorted(message.id for message in old))
+        self.assertEqual((job.scanned, job.matched, job.deleted, job.failed), (108, 108, 108, 0))
+        self.assertEqual(self.channel.history_args["oldest_first"], False)
+        self.assertIsNone(self.engine.running(self.channel.id))
+
+    async def test_limit_deletes_newest_messages(self):
+        messages = [self.channel.add(datetime.timedelta(days=index * 5)) for index in range(6)]
+
+        job = await self.engine.run(self.channel, limit=4)
+
+        self.assertEqual(deleted(self.channel), sorted(message.id for message in messages[:4]))
+        self.assertEqual((job.matched, job.deleted), (4, 4))
+
+    async def test_excluded_messages_kept(self):
+        command = self.channel.add(datetime.timedelta(seconds=1))
+        others = [self.channel.add(datetime.timedelta(minutes=index + 1)) for index in range(3)]
+
+        job = await self.engine.run(self.channel, limit=3, exclude=[command.id])
+
+        self.assertEqual(deleted(self.channel), sorted(message.id for message in others))
+        self.assertEqual((job.scanned, job.matched), (4, 3))
+
+
+class PurgeFilterTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.engine = PurgeEngine(FakeBot())
+        self.channel = FakeChannel()
+
+    async def test_only_matches_deleted_and_limit_counts_matches(self):
+        alice, bob = FakeAuthor(1, "alice"), FakeAuthor(2, "bob")
+        matches = []
+        for index in range(6):
+            author = alice if index % 2 else bob
+            message = self.channel.add(datetime.timedelta(days=index * 4), author=author)
+            if author is alice:
+                matches.append(message)
+
+        job = await self.engine.run(self.channel, limit=2, predicate=PurgeFilter(author_id=alice.id))
+
+        self.assertEqual(deleted(self.channel), sorted(message.id for message in matches[:2]))
+        self.assertEqual((job.scanned, job.matched, job.deleted), (4, 2, 2))
+
+    async def test_window_passed_to_history(self):
+        before = datetime.datetime(2024, 2, 1, tzinfo=datetime.timezone.utc)
+        after = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+
+        await self.engine.run(self.channel, predicate=PurgeFilter(before=before, after=after))
+
+        self.assertEqual(self.channel.history_args, {"before": before, "after": after, "oldest_first": False})
+
+    def test_criteria_combine(self):
+        purge_filter = PurgeFilter(persona="user_abc", pattern=re.compile(r"spam\d"), has_attachments=True)
+        persona = FakeAuthor(99, "user_abc")
+        self.assertTrue(purge_filter(FakeMessage(self.channel, 1, datetime.timedelta(0), persona, "spam1", webhook_id=5, attachments=["a"])))
+        # Same name but not posted through the webhook
+        self.assertFalse(purge_filter(FakeMessage(self.channel, 2, datetime.timedelta(0), persona, "spam1", attachments=["a"])))
+        self.assertFalse(purge_filter(FakeMessage(self.channel, 3, datetime.timedelta(0), persona, "ham1", webhook_id=5, attachments=["a"])))
+        self.assertFalse(purge_filter(FakeMessage(self.channel, 4, datetime.timedelta(0), persona, "spam1", webhook_id=5)))
+
+    async def test_parse_filter_tokens(self):
+        cog = AdminCmd(FakeBot())
+        purge_filter = await cog._parse_purge_filter(None, ["user:<@!123>", "persona:admin_x", "regex:^a\\sb", "has:Attachments", "after:2024-01-02T03:04"])
+        self.assertEqual(purge_filter.author_id, 123)
+        self.assertEqual(purge_filter.persona, "admin_x")
+        self.assertTrue(purge_filter.pattern.search("a b"))
+        self.assertTrue(purge_filter.has_attachments)
+        self.assertEqual(purge_filter.after, datetime.datetime(2024, 1, 2, 3, 4, tzinfo=datetime.timezone.utc))
+        self.assertIsNone(purge_filter.before)
+
+        for tokens in (["persona:bob"], ["regex:("], ["has:links"], ["before:yesterday"], ["user:"]):
+            with self.assertRaises(ValueError):
+                await cog._parse_purge_filter(None, tokens)
+
+
+if __name__ == "__main__":
+    unittest.main()
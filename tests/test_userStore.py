@@ -0,0 +1,119 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+from userStore import UserStore, PSEUDONYM_LENGTH
+
+
+class UserStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.path = os.path.join(self.dir.name, "users.db")
+        self.journal_path = os.path.join(self.dir.name, "users.journal.jsonl")
+
+    def open_store(self):
+        return UserStore(self.path, self.journal_path)
+
+    def crash(self, store):
+        # Drop the process's handles without the compaction close() would run
+        store._journal.close()
+        store.conn.close()
+
+    def snapshot(self):
+        conn = sqlite3.connect(self.path)
+        try:
+            return {row[0]: row[1:] for row in conn.execute("SELECT user_key, user_id, admin_id, channel_id FROM users")}
+        finally:
+            conn.close()
+
+    def test_journal_replayed_after_crash(self):
+        store = self.open_store()
+        store.create("alice", "idA", "user")
+        store.create("bob", "idB", "admin", admin_id="admB")
+        store.update("alice", channel_id=11)
+        store.delete("bob")
+        self.crash(store)
+        # The snapshot never saw these changes; only the journal has them
+        self.assertEqual(self.snapshot(), {})
+        with open(self.journal_path, 'a', encoding='utf-8') as f:
+            f.write('{"seq": 99, "op": "crea')
+
+        store = self.open_store()
+        self.addCleanup(store.close)
+        self.assertEqual(store.get("alice")["channel_id"], 11)
+        self.assertEqual([entry["role"] for entry in store.get("alice")["role_history"]], ["user"])
+        self.assertIsNone(store.get("bob"))
+        self.assertEqual(store.by_channel_id, {11: "alice"})
+        # Opening compacted the replayed changes
+        self.assertEqual(self.snapshot(), {"alice": ("idA", None, 11)})
+        self.assertEqual(os.path.getsize(self.journal_path), 0)
+
+    def test_crash_between_commit_and_truncate_does_not_replay_twice(self):
+        store = self.open_store()
+        store.create("alice", "idA", "user")
+        with open(self.journal_path, encoding='utf-8') as f:
+            journal = f.read()
+        store.compact()
+        self.crash(store)
+        with open(self.journal_path, 'w', encoding='utf-8') as f:
+            f.write(journal)
+
+        store = self.open_store()
+        store.close()
+        conn = sqlite3.connect(self.path)
+        self.addCleanup(conn.close)
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM role_history").fetchone()[0], 1)
+
+    def test_delete_and_recreate_across_compaction(self):
+        store = self.open_store()
+        store.create("alice", "idA", "admin", admin_id="admA")
+        store.update("alice", channel_id=11)
+        store.compact()
+
+        store.delete("alice")
+        store.create("alice", "idA2", "user")
+        # Another user takes over the freed pseudonyms and channel in the same window
+        store.create("bob", "idA", "admin", admin_id="admA")
+        store.update("bob", channel_id=11)
+        store.compact()
+        self.assertEqual(os.path.getsize(self.journal_path), 0)
+        store.close()
+
+        self.assertEqual(self.snapshot(), {"alice": ("idA2", None, None), "bob": ("idA", "admA", 11)})
+        store = self.open_store()
+        self.addCleanup(store.close)
+        self.assertEqual([entry["role"] for entry in store.get("alice")["role_history"]], ["user"])
+        self.assertEqual(store.by_channel_id, {11: "bob"})
+
+    def test_swap_admin_and_channel_ids_across_compaction(self):
+        store = self.open_store()
+        store.create("alice", "idA", "admin", admin_id="admA")
+        store.create("bob", "idB", "admin", admin_id="admB")
+        store.update("alice", channel_id=11)
+        store.update("bob", channel_id=22)
+        store.compact()
+
+        store.update("alice", admin_id="admB", channel_id=22)
+        store.update("bob", admin_id="admA", channel_id=11)
+        store.compact()
+        # A failed compaction keeps the journal for the next attempt
+        self.assertEqual(os.path.getsize(self.journal_path), 0)
+        store.close()
+
+        self.assertEqual(self.snapshot(), {"alice": ("idA", "admB", 22), "bob": ("idB", "admA", 11)})
+
+    def test_allocate_id_skips_taken_and_excluded(self):
+        store = self.open_store()
+        self.addCleanup(store.close)
+        store.create("alice", "a" * PSEUDONYM_LENGTH, "admin", admin_id="b" * PSEUDONYM_LENGTH)
+        # Draws the user ID, the admin ID and the excluded ID before a free one
+        draws = "".join(letter * PSEUDONYM_LENGTH for letter in "abcd")
+        with mock.patch("userStore.secrets.choice", side_effect=draws):
+            self.assertEqual(store.allocate_id(exclude=("c" * PSEUDONYM_LENGTH,)), "d" * PSEUDONYM_LENGTH)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,373 @@
+import sqlite3
+import asyncio
+import json
+import os
+import secrets
+import string
+import datetime
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_key TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL UNIQUE,
+    role TEXT NOT NULL,
+    admin_id TEXT UNIQUE,
+    last_admin_request TEXT,
+    channel_id INTEGER UNIQUE
+);
+CREATE INDEX IF NOT EXISTS idx_users_role ON users(role);
+CREATE TABLE IF NOT EXISTS role_history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_key TEXT NOT NULL REFERENCES users(user_key) ON DELETE CASCADE ON UPDATE CASCADE,
+    role TEXT NOT NULL,
+    timestamp TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_role_history_user ON role_history(user_key);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+USER_FIELDS = ("user_id", "role", "admin_id", "last_admin_request", "channel_id")
+
+# Columns added after the first release, created on existing databases at startup
+MIGRATIONS = {
+    "channel_id": "ALTER TABLE users ADD COLUMN channel_id INTEGER",
+}
+
+# Pseudonyms are 12 characters from a 62-letter alphabet (~71 bits)
+PSEUDONYM_ALPHABET = string.ascii_letters + string.digits
+PSEUDONYM_LENGTH = 12
+
+# Compaction timing: fold the journal into the snapshot this long after the first change,
+# or straight away once the journal grows past the entry limit
+COMPACT_INTERVAL = 30.0
+COMPACT_MAX_ENTRIES = 1000
+
+
+class UserStore:
+    def __init__(self, path, journal_path=None, compact_interval=COMPACT_INTERVAL, compact_max_entries=COMPACT_MAX_ENTRIES):
+        self.path = path
+        self.journal_path = journal_path or os.path.splitext(path)[0] + ".journal.jsonl"
+        self.compact_interval = compact_interval
+        self.compact_max_entries = compact_max_entries
+        self.conn = sqlite3.connect(path)
+        self.conn.row_factory = sqlite3.Row
+        # WAL lets readers run while a write is in progress and keeps commits cheap
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA foreign_keys=ON")
+        self.conn.executescript(SCHEMA)
+        self._migrate()
+        self.conn.commit()
+
+        # In-memory table shared by every cog; the database only holds the last compacted snapshot
+        self.users = {}
+        self.by_user_id = {}
+        self.by_admin_id = {}
+        self.by_channel_id = {}
+        self._dirty = set()
+        self._deleted = set()
+        self._pending_history = []
+        self._journal_entries = 0
+        self._compact_handle = None
+        self._seq = 0
+        self._load()
+
+        # Replay whatever the last run journaled after its final compaction
+        self._replay()
+        self._journal = open(self.journal_path, 'a', encoding='utf-8')
+        self.compact()
+
+    def _migrate(self):
+        columns = {row["name"] for row in self.conn.execute("PRAGMA table_info(users)")}
+        for column, statement in MIGRATIONS.items():
+            if column not in columns:
+                self.conn.execute(statement)
+                self.conn.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS idx_users_{column} ON users({column})")
+
+    def _load(self):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'journal_seq'").fetchone()
+        self._seq = int(row["value"]) if row else 0
+        self.users.clear()
+        self.by_user_id.clear()
+        self.by_admin_id.clear()
+        self.by_channel_id.clear()
+        for row in self.conn.execute("SELECT * FROM users"):
+            record = {field: row[field] for field in USER_FIELDS}
+            record["role_history"] = []
+            self.users[row["user_key"]] = record
+        for row in self.conn.execute("SELECT user_key, role, timestamp FROM role_history ORDER BY id"):
+            record = self.users.get(row["user_key"])
+            if record is None:
+                continue
+            # Entries imported without a timestamp keep their old bare-string form
+            if row["timestamp"] is None:
+                record["role_history"].append(row["role"])
+            else:
+                record["role_history"].append({"role": row["role"], "timestamp": row["timestamp"]})
+        for user_key, record in self.users.items():
+            self._index(user_key, record)
+
+    def _index(self, user_key, record):
+        self.by_user_id[record["user_id"]] = user_key
+        if record.get("admin_id"):
+            self.by_admin_id[record["admin_id"]] = user_key
+        if record.get("channel_id"):
+            self.by_channel_id[record["channel_id"]] = user_key
+
+    def _unindex(self, record):
+        self.by_user_id.pop(record["user_id"], None)
+        if record.get("admin_id"):
+            self.by_admin_id.pop(record["admin_id"], None)
+        if record.get("channel_id"):
+            self.by_channel_id.pop(record["channel_id"], None)
+
+    def _copy(self, record):
+        if record is None:
+            return None
+        record = dict(record)
+        record["role_history"] = list(record["role_history"])
+        return record
+
+    def get(self, user_key):
+        return self._copy(self.users.get(user_key))
+
+    def get_by_user_id(self, user_id):
+        user_key = self.by_user_id.get(user_id)
+        if user_key is None:
+            return None, None
+        return user_key, self.get(user_key)
+
+    def get_by_admin_id(self, admin_id):
+        user_key = self.by_admin_id.get(admin_id)
+        if user_key is None:
+            return None, None
+        return user_key, self.get(user_key)
+
+    def get_by_channel_id(self, channel_id):
+        user_key = self.by_channel_id.get(channel_id)
+        if user_key is None:
+            return None, None
+        return user_key, self.get(user_key)
+
+    def id_taken(self, pseudonym):
+        return pseudonym in self.by_user_id or pseudonym in self.by_admin_id
+
+    def allocate_id(self, exclude=()):
+        # Drawn from a CSPRNG and checked against the in-memory pseudonym index, so allocation is O(1).
+        # Callers store the ID before their next await, so no reservation is needed; exclude
+        # covers IDs allocated together for one record.
+        while True:
+            pseudonym = ''.join(secrets.choice(PSEUDONYM_ALPHABET) for _ in range(PSEUDONYM_LENGTH))
+            if not self.id_taken(pseudonym) and pseudonym not in exclude:
+                return pseudonym
+
+    def admin_keys(self):
+        return [user_key for user_key, record in self.users.items() if record["role"] == "admin"]
+
+    def items(self):
+        for user_key in sorted(self.users):
+            yield user_key, self.get(user_key)
+
+    def _replay(self):
+        if not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A torn last line from a crash mid-append; everything before it is intact
+                    print(f"Skipping unreadable journal line in {self.journal_path}")
+                    continue
+                # Entries up to the snapshot's sequence number are already in the database
+                if entry.get("seq", 0) <= self._seq:
+                    continue
+                self._seq = entry["seq"]
+                self._apply(entry)
+
+    def _apply(self, entry):
+        op = entry["op"]
+        user_key = entry["key"]
+        if op == "create":
+            old = self.users.get(user_key)
+            if old is not None:
+                self._unindex(old)
+            record = {"user_id": entry["user_id"], "role": entry["role"], "admin_id": entry.get("admin_id"), "last_admin_request": None, "channel_id": None, "role_history": []}
+            self.users[user_key] = record
+            self._index(user_key, record)
+            self._dirty.add(user_key)
+        elif op == "update":
+            record = self.users.get(user_key)
+            if record is None:
+                return
+            self._unindex(record)
+            record.update(entry["fields"])
+            self._index(user_key, record)
+            self._dirty.add(user_key)
+        elif op == "history":
+            record = self.users.get(user_key)
+            if record is None:
+                return
+            record["role_history"].append({"role": entry["role"], "timestamp": entry["timestamp"]})
+            self._pending_history.append((user_key, entry["role"], entry["timestamp"]))
+            self._dirty.add(user_key)
+        elif op == "delete":
+            record = self.users.pop(user_key, None)
+            if record is None:
+                return
+            self._unindex(record)
+            self._dirty.discard(user_key)
+            self._pending_history = [item for item in self._pending_history if item[0] != user_key]
+            self._deleted.add(user_key)
+
+    def _write(self, op, user_key, **data):
+        # Append the change to the journal before applying it, so each write costs one line
+        self._seq += 1
+        entry = {"seq": self._seq, "op": op, "key": user_key, **data}
+        self._journal.write(json.dumps(entry) + "\n")
+        self._journal.flush()
+        self._journal_entries += 1
+        self._apply(entry)
+        self._schedule_compaction()
+
+    def create(self, user_key, user_id, role, admin_id=None):
+        if user_key in self.users:
+            raise KeyError(f"User {user_key} already exists")
+        self._write("create", user_key, user_id=user_id, role=role, admin_id=admin_id)
+        self._write("history", user_key, role=role, timestamp=datetime.datetime.now().isoformat())
+        return self.get(user_key)
+
+    def update(self, user_key, **fields):
+        unknown = set(fields) - set(USER_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown user fields: {', '.join(sorted(unknown))}")
+        if user_key not in self.users or not fields:
+            return
+        self._write("update", user_key, fields=fields)
+
+    def append_role_history(self, user_key, role):
+        if user_key not in self.users:
+            return
+        self._write("history", user_key, role=role, timestamp=datetime.datetime.now().isoformat())
+
+    def set_role(self, user_key, role, **fields):
+        fields["role"] = role
+        self.update(user_key, **fields)
+        self.append_role_history(user_key, role)
+
+    def delete(self, user_key):
+        if user_key not in self.users:
+            return False
+        self._write("delete", user_key)
+        return True
+
+    def _schedule_compaction(self):
+        if self._journal_entries >= self.compact_max_entries:
+            self.compact()
+            return
+        if self._compact_handle is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # No event loop (scripts, migrations): the journal stays until the next compaction or close
+            return
+        self._compact_handle = loop.call_later(self.compact_interval, self.compact)
+
+    def compact(self):
+        if self._compact_handle is not None:
+            self._compact_handle.cancel()
+            self._compact_handle = None
+        if not (self._dirty or self._deleted or self._pending_history):
+            self._truncate_journal()
+            return
+
+        dirty, deleted, history = self._dirty, self._deleted, self._pending_history
+        self._dirty, self._deleted, self._pending_history = set(), set(), []
+        try:
+            # Fold the journaled changes into the snapshot in one transaction, tagged with the
+            # last sequence number so a crash before the truncate doesn't replay them twice
+            with self.conn:
+                for user_key in deleted:
+                    self.conn.execute("DELETE FROM users WHERE user_key = ?", (user_key,))
+                # Release pseudonyms and channels held by rows being rewritten before reassigning them
+                for user_key in dirty:
+                    self.conn.execute("UPDATE users SET admin_id = NULL, channel_id = NULL WHERE user_key = ?", (user_key,))
+                for user_key in dirty:
+                    record = self.users[user_key]
+                    self.conn.execute(
+                        "INSERT INTO users (user_key, user_id, role, admin_id, last_admin_request, channel_id) VALUES (?, ?, ?, ?, ?, ?) "
+                        "ON CONFLICT(user_key) DO UPDATE SET user_id = excluded.user_id, role = excluded.role, "
+                        "admin_id = excluded.admin_id, last_admin_request = excluded.last_admin_request, "
+                        "channel_id = excluded.channel_id",
+                        (user_key, record["user_id"], record["role"], record["admin_id"], record["last_admin_request"], record["channel_id"])
+                    )
+                self.conn.executemany(
+                    "INSERT INTO role_history (user_key, role, timestamp) VALUES (?, ?, ?)",
+                    history
+                )
+                self.conn.execute(
+                    "INSERT INTO meta (key, value) VALUES ('journal_seq', ?) "
+                    "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                    (str(self._seq),)
+                )
+        except Exception as e:
+            # Keep the changes queued (they are still in the journal) so the next compaction retries them
+            self._dirty |= dirty
+            self._deleted |= deleted
+            self._pending_history = history + self._pending_history
+            print(f"Error compacting user store: {e}")
+            return
+        self._truncate_journal()
+
+    def _truncate_journal(self):
+        self._journal.seek(0)
+        self._journal.truncate()
+        self._journal_entries = 0
+
+    def close(self):
+        self.compact()
+        self._journal.close()
+        self.conn.close()
+
+    def import_json(self, json_path):
+        # One-time migration of the legacy user_ids.json file
+        if not os.path.exists(json_path):
+            return 0
+        if self.users or self._seq:
+            return 0
+
+        with open(json_path, 'r') as f:
+            user_ids = json.load(f)
+
+        imported = 0
+        with self.conn:
+            for user_key, data in user_ids.items():
+                if isinstance(data, str):
+                    # Oldest format only stored the user_id
+                    data = {"user_id": data, "role": "user", "admin_id": None, "role_history": []}
+                if not isinstance(data, dict) or not data.get("user_id"):
+                    continue
+                self.conn.execute(
+                    "INSERT INTO users (user_key, user_id, role, admin_id, last_admin_request) VALUES (?, ?, ?, ?, ?)",
+                    (user_key, data["user_id"], data.get("role") or "user", data.get("admin_id"), data.get("last_admin_request"))
+                )
+                for entry in data.get("role_history", []):
+                    if isinstance(entry, dict):
+                        role, timestamp = entry.get("role"), entry.get("timestamp")
+                    else:
+                        role, timestamp = entry, None
+                    if not role:
+                        continue
+                    self.conn.execute(
+                        "INSERT INTO role_history (user_key, role, timestamp) VALUES (?, ?, ?)",
+                        (user_key, role, timestamp)
+                    )
+                imported += 1
+
+        os.replace(json_path, json_path + ".imported")
+        self._load()
+        return imported
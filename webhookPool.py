@@ -0,0 +1,67 @@
+import asyncio
+import discord
+
+WEBHOOK_NAME = "MaskerBot"
+
+
+class WebhookPool:
+    def __init__(self, bot):
+        self.bot = bot
+        # channel_id -> one bot-owned webhook, reused for every anonymous post in that channel
+        self._webhooks = {}
+        self._locks = {}
+
+    def _owned(self, webhook):
+        return webhook.token is not None and webhook.user is not None and webhook.user.id == self.bot.user.id
+
+    async def discover(self, guild):
+        # Adopt the webhooks a previous run created, one API call per guild
+        try:
+            webhooks = await guild.webhooks()
+        except discord.HTTPException as e:
+            print(f"Could not list webhooks in {guild}: {e}")
+            return
+        for webhook in webhooks:
+            if self._owned(webhook) and webhook.channel_id:
+                self._webhooks.setdefault(webhook.channel_id, webhook)
+
+    async def get(self, channel):
+        webhook = self._webhooks.get(channel.id)
+        if webhook:
+            return webhook
+
+        # One creator per channel, so concurrent sends don't each create a webhook
+        lock = self._locks.setdefault(channel.id, asyncio.Lock())
+        async with lock:
+            webhook = self._webhooks.get(channel.id)
+            if webhook:
+                return webhook
+            for existing in await channel.webhooks():
+                if self._owned(existing):
+                    webhook = existing
+                    break
+            else:
+                avatar_bytes = await self.bot.user.avatar.read() if self.bot.user.avatar else None
+                webhook = await channel.create_webhook(name=WEBHOOK_NAME, avatar=avatar_bytes)
+            self._webhooks[channel.id] = webhook
+            return webhook
+
+    def forget(self, channel_id):
+        self._webhooks.pop(channel_id, None)
+        self._locks.pop(channel_id, None)
+
+    async def send(self, channel, username, content=None, files=None):
+        avatar_url = self.bot.user.avatar.url if self.bot.user.avatar else None
+        kwargs = {"content": content, "username": username, "avatar_url": avatar_url}
+        if files:
+            kwargs["files"] = files
+        webhook = await self.get(channel)
+        try:
+            return await webhook.send(**kwargs)
+        except discord.NotFound:
+            # The webhook was deleted behind our back: recreate it and retry once
+            self.forget(channel.id)
+            for file in files or []:
+                file.reset()
+            webhook = await self.get(channel)
+            return await webhook.send(**kwargs)